@@ -1,17 +1,55 @@
-let router = null;
+import { reactive } from 'vue';
 
 export function url_for(endpoint, args) {
-    if (router === null) {
-        router = eval('(' + window._bootstrap_data.router + ')');
-    }
-
-    return router[endpoint](args);
+    return window._router[endpoint](args);
 }
 
 export function navigate(endpoint, args) {
     window.location = url_for(endpoint, args);
 }
 
+export async function fetch_page(endpoint, args, after) {
+    const response = await fetch(`${url_for(endpoint, args)}?after=${after}`);
+
+    return response.json();
+}
+
+export async function search(endpoint, query) {
+    const response = await fetch(`${url_for(endpoint)}?q=${encodeURIComponent(query)}`);
+    const result = await response.json();
+
+    return result.items;
+}
+
+// Keeps the first page inlined in the bootstrap data and appends the following
+// pages to the same list on demand.
+export function paginated(endpoint, args, items, next) {
+    const list = reactive(items);
+
+    const page = reactive({
+        next,
+        loading: false,
+
+        async more () {
+            if (page.next === null || page.loading)
+                return;
+
+            page.loading = true;
+
+            try {
+                const result = await fetch_page(endpoint, args, page.next);
+
+                list.push(...result.items);
+                page.next = result.next;
+            } finally {
+                page.loading = false;
+            }
+        },
+    });
+
+    return [ list, page ];
+}
+
 function getCookie(name) {
     const value = `; ${document.cookie}`;
     const parts = value.split(`; ${name}=`);
@@ -27,7 +65,14 @@ export default {
         app.config.globalProperties.$user = window._bootstrap_data.user;
         app.config.globalProperties.$csrf_token = getCookie('csrf_access_token');
 
-        app.provide('all_groups', window._bootstrap_data.groups || []);
-        app.provide('all_users', window._bootstrap_data.users || []);
+        const data = window._bootstrap_data;
+
+        const [ groups, groups_page ] = paginated('api_groups', {}, data.groups || [], data.groups_next ?? null);
+        const [ users, users_page ] = paginated('api_users', {}, data.users || [], data.users_next ?? null);
+
+        app.provide('all_groups', groups);
+        app.provide('groups_page', groups_page);
+        app.provide('all_users', users);
+        app.provide('users_page', users_page);
     }
 };
\ No newline at end of file
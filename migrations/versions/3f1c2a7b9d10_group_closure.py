@@ -0,0 +1,46 @@
+"""Add the group hierarchy closure table
+
+Revision ID: 3f1c2a7b9d10
+Revises: 
+Create Date: 2026-10-17 10:12:31.402215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7b9d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'group_closure' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table('group_closure',
+            sa.Column('ancestor_id', sa.Integer(), nullable=False),
+            sa.Column('descendant_id', sa.Integer(), nullable=False),
+            sa.Column('depth', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['ancestor_id'], ['group.id'], ),
+            sa.ForeignKeyConstraint(['descendant_id'], ['group.id'], ),
+            sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+        )
+        op.create_index(op.f('ix_group_closure_descendant_id'), 'group_closure', ['descendant_id'], unique=False)
+
+    op.execute('DELETE FROM group_closure')
+    op.execute('''
+        INSERT INTO group_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM "group"
+            UNION ALL
+            SELECT tree.ancestor_id, "group".id, tree.depth + 1
+            FROM tree JOIN "group" ON "group".parent_id = tree.descendant_id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM tree
+    ''')
+
+
+def downgrade():
+    op.drop_index(op.f('ix_group_closure_descendant_id'), table_name='group_closure')
+    op.drop_table('group_closure')
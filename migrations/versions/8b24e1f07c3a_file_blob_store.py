@@ -0,0 +1,70 @@
+"""Move file contents into the content-addressed blob store
+
+Revision ID: 8b24e1f07c3a
+Revises: 3f1c2a7b9d10
+Create Date: 2026-10-17 12:40:08.913371
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from flask import current_app
+
+from tsoha.storage import BlobStore
+
+
+# revision identifiers, used by Alembic.
+revision = '8b24e1f07c3a'
+down_revision = '3f1c2a7b9d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    columns = [ column['name'] for column in sa.inspect(connection).get_columns('file') ]
+
+    if 'data' not in columns:
+        return
+
+    if 'digest' not in columns:
+        with op.batch_alter_table('file') as batch_op:
+            batch_op.add_column(sa.Column('digest', sa.String(length=64), nullable=True))
+            batch_op.add_column(sa.Column('size', sa.Integer(), nullable=True))
+
+    store = BlobStore(current_app)
+    ids = [ row[0] for row in connection.execute(sa.text('SELECT id FROM file')) ]
+
+    # One row at a time, so that only a single file is held in memory.
+    for id in ids:
+        data = connection.execute(sa.text('SELECT data FROM file WHERE id = :id'), id=id).scalar()
+        digest, size = store.put(data)
+
+        connection.execute(
+            sa.text('UPDATE file SET digest = :digest, size = :size WHERE id = :id'),
+            digest=digest, size=size, id=id,
+        )
+
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.alter_column('digest', existing_type=sa.String(length=64), nullable=False)
+        batch_op.alter_column('size', existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_column('data')
+
+
+def downgrade():
+    connection = op.get_bind()
+
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.add_column(sa.Column('data', sa.LargeBinary(), nullable=True))
+
+    store = BlobStore(current_app)
+    rows = connection.execute(sa.text('SELECT id, digest FROM file')).fetchall()
+
+    for id, digest in rows:
+        with store.open(digest) as f:
+            connection.execute(sa.text('UPDATE file SET data = :data WHERE id = :id'), data=f.read(), id=id)
+
+    with op.batch_alter_table('file') as batch_op:
+        batch_op.alter_column('data', existing_type=sa.LargeBinary(), nullable=False)
+        batch_op.drop_column('size')
+        batch_op.drop_column('digest')
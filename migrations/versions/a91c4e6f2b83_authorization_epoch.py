@@ -0,0 +1,31 @@
+"""Add per-user authorization epochs
+
+Revision ID: a91c4e6f2b83
+Revises: e7a4b2c90d15
+Create Date: 2026-10-17 22:41:09.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91c4e6f2b83'
+down_revision = 'e7a4b2c90d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Users without a row are at epoch 0, so existing users need none.
+    op.create_table('authorization_epoch',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('epoch', sa.Integer(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('authorization_epoch')
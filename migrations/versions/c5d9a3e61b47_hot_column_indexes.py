@@ -0,0 +1,41 @@
+"""Index the columns used by logins, lookups and relationship loads
+
+Revision ID: c5d9a3e61b47
+Revises: 8b24e1f07c3a
+Create Date: 2026-10-17 15:21:44.107935
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d9a3e61b47'
+down_revision = '8b24e1f07c3a'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_user_username', 'user', ['username'], True),
+    ('ix_user_supervisor_id', 'user', ['supervisor_id'], False),
+    ('ix_file_owner_id', 'file', ['owner_id'], False),
+    ('ix_group_name', 'group', ['name'], False),
+    ('ix_group_parent_id', 'group', ['parent_id'], False),
+    ('ix_group_membership_group_id', 'group_membership', ['group_id'], False),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    # Creating the unique index fails if usernames are already duplicated;
+    # those accounts have to be renamed by hand before upgrading.
+    for name, table, columns, unique in INDEXES:
+        if name not in [ index['name'] for index in inspector.get_indexes(table) ]:
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    for name, table, _columns, _unique in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
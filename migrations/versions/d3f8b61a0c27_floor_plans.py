@@ -0,0 +1,57 @@
+"""Add buildings, floors and rooms
+
+Revision ID: d3f8b61a0c27
+Revises: a91c4e6f2b83
+Create Date: 2026-10-17 23:58:12.604131
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f8b61a0c27'
+down_revision = 'a91c4e6f2b83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('building',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('floor',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('building_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('level', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['building_id'], ['building.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_floor_building_id'), 'floor', ['building_id'], unique=False)
+    op.create_table('room',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('floor_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('polygon', sa.Text(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.Column('min_x', sa.Float(), nullable=False),
+        sa.Column('min_y', sa.Float(), nullable=False),
+        sa.Column('max_x', sa.Float(), nullable=False),
+        sa.Column('max_y', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['floor_id'], ['floor.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_room_floor_id_version', 'room', ['floor_id', 'version'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_room_floor_id_version', table_name='room')
+    op.drop_table('room')
+    op.drop_index(op.f('ix_floor_building_id'), table_name='floor')
+    op.drop_table('floor')
+    op.drop_table('building')
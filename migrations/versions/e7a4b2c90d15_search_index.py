@@ -0,0 +1,44 @@
+"""Add full-text search indexes for users and groups
+
+Revision ID: e7a4b2c90d15
+Revises: c5d9a3e61b47
+Create Date: 2026-10-17 20:14:37.482916
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a4b2c90d15'
+down_revision = 'c5d9a3e61b47'
+branch_labels = None
+depends_on = None
+
+
+# Kept in sync with tsoha/models/search.py, which also maintains the rows.
+INDEXES = [
+    ('user_search', 'user', ['username', 'name', 'email']),
+    ('group_search', 'group', ['name']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for name, source, columns in INDEXES:
+        op.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({', '.join(columns)}, prefix='1 2 3', tokenize='unicode61 remove_diacritics 2')")
+        op.execute(f'DELETE FROM {name}')
+
+        values = ', '.join("coalesce(%s, '')" % column for column in columns)
+
+        op.execute(f'INSERT INTO {name} (rowid, {", ".join(columns)}) SELECT id, {values} FROM "{source}"')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for name, _source, _columns in reversed(INDEXES):
+        op.execute(f'DROP TABLE IF EXISTS {name}')
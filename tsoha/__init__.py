@@ -1,37 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, set_access_cookies, unset_access_cookies, current_user, get_jwt_identity, get_current_user, verify_jwt_in_request
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, make_response, send_file, stream_with_context
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, set_access_cookies, unset_access_cookies, current_user, get_jwt_identity, get_current_user
 
+import io
+import os
+import re
 import json
+import hashlib
 
-from sqlalchemy import and_, select
+from datetime import datetime
+from functools import wraps
+
+from sqlalchemy import and_
 from sqlalchemy.orm import aliased, joinedload
+from werkzeug.http import is_resource_modified
 import base64
 
 from tsoha.config import get_config
+from tsoha.database import Database, Migrations
+from tsoha.cli import LazyGroup
+from tsoha.instrumentation import Instrumentation
 
 app = Flask(__name__, template_folder='../build/templates', static_folder='../build')
+app.cli = LazyGroup('tsoha.commands', name=app.name)
 
-get_config(app)
-
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+# The app and its views are created at import time, as a single module-level
+# instance, but extensions are bound to it only by configure_app(), so that
+# importing the package reads no configuration and opens no database
+# connections.
+db = Database()
+migrations = Migrations()
+instrumentation = Instrumentation()
 
-from tsoha.auth import authenticate, get_user
+from tsoha.auth import authenticate, get_user, get_request_user, get_user_memberships, request_cache, password_hasher
 
-jwt = JWTManager(app)
+jwt = JWTManager()
 
 @jwt.user_identity_loader
 def jwt_identity_loader(user):
     return user.id
 
+# Endpoints that only need to know that the user of a token still exists,
+# which the authorization snapshot answers without a query.
+SNAPSHOT_AUTHENTICATED_ENDPOINTS = ('api_decision', 'api_decisions')
+
 @jwt.user_lookup_loader
 def jwt_user_loader(_jwt_header, jwt_data):
-    return get_user(jwt_data["sub"])
+    with instrumentation.phase('auth'):
+        if request.endpoint in SNAPSHOT_AUTHENTICATED_ENDPOINTS:
+            return jwt_data["sub"] if authorizer.current().has_user(jwt_data["sub"]) else None
+
+        return get_user(jwt_data["sub"])
 
 @jwt.expired_token_loader
 def expired_token_loader(_jwt_header, jwt_data):
@@ -47,31 +68,131 @@ def invalid_token_loader(reason):
     return response
 
 
-import tsoha.commands
 import tsoha.models
 
-db.create_all()
+from tsoha.models import User, Group, GroupMembership, GroupClosure, File, Building, Floor, search, get_epoch
+from tsoha.cache import PermissionCache, FragmentCache
+from tsoha.serialization import CustomEncoder, serialize, eager_load
+from tsoha.storage import BlobStore, BlobTooLarge
+from tsoha.thumbnails import Thumbnailer
+from tsoha.spatial import SpatialIndex
+from tsoha.hierarchy import ReportingLines
+
+permission_cache = PermissionCache()
+bootstrap_cache = FragmentCache()
+blob_store = BlobStore()
+thumbnailer = Thumbnailer()
+spatial_index = SpatialIndex()
+reporting_lines = ReportingLines()
+
+def configure_app():
+    # Reads the configuration into the module-level app and binds the
+    # extensions to it on the first call, and returns it. This is not an
+    # application factory: every call returns the same app, so there can be
+    # only one configuration per process. The database schema is created by
+    # 'flask init-db' or the migrations.
+    if app.extensions.get('tsoha'):
+        return app
+
+    get_config(app)
+
+    db.init_app(app)
+    migrations.init_app(app, db)
+    jwt.init_app(app)
+    instrumentation.init_app(app)
+
+    password_hasher.init_app(app)
+    permission_cache.init_app(app)
+    bootstrap_cache.init_app(app)
+    blob_store.init_app(app)
+    thumbnailer.init_app(app, blob_store)
+    spatial_index.init_app(app)
+    reporting_lines.init_app(app)
+    authorizer.init_app(app)
+
+    app.extensions['tsoha'] = True
+
+    return app
+
+from tsoha.permissions import PERMISSIONS, check_permissions, allowed_groups, permitted_groups_query, has_permission_in_any_group
+from tsoha.authorization import ACTIONS, Authorizer
+
+authorizer = Authorizer()
+
+from tsoha.provisioning import IMPORT_FORMATS, DEFAULT_CHUNK_SIZE, read_rows, import_users
+from tsoha.export import EXPORT_TABLES, EXPORT_FORMATS, export
+from tsoha.floorplans import InvalidChange, VersionConflict, apply_changes, changed_rooms, parse_box, parse_building, parse_floor
+
+def get_authorization_epoch(user):
+    # (epoch, time of the last change) of the user, read once per request.
+    epochs = request_cache('epochs')
+
+    if user.id not in epochs:
+        epochs[user.id] = get_epoch(db.session, user.id)
+
+    return epochs[user.id]
+
+def template_version(template):
+    # Modification time of the template file, which changes with every build
+    # of the frontend.
+    filename = app.jinja_env.get_template(template).filename
+
+    if filename is None or not os.path.isfile(filename):
+        return None
+
+    return datetime.utcfromtimestamp(int(os.path.getmtime(filename)))
+
+def conditional_on_epoch(template=None):
+    # For views whose response only depends on the URL, on what the user can
+    # see and, for pages, on the template. Those are summed up in an ETag and
+    # Last-Modified, and a request carrying a current one is answered with 304
+    # Not Modified without running the view.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user = get_request_user()
+
+            if user is None or not app.config.get('HTTP_CACHING', True):
+                return view(*args, **kwargs)
+
+            epoch, changed_at = get_authorization_epoch(user)
+            version = template_version(template) if template else None
+
+            etag = hashlib.sha1(f'{user.id}:{epoch}:{version}:{router_etag()}:{request.full_path}'.encode('utf-8')).hexdigest()
+            last_modified = max(filter(None, (changed_at, version)), default=None)
 
-from tsoha.models import User, Group, GroupMembership, File
+            # Last-Modified has a resolution of a second, so it only decides
+            # for clients that send no If-None-Match.
+            if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.update(('Cookie', 'Authorization'))
+
+            return response
+
+        return wrapper
+
+    return decorator
 
 @app.context_processor
 def current_user_context():
-    try:
-        verify_jwt_in_request(optional=True)
-    except Exception as e:
-        return dict(
-            authenticated=False,
-            current_user=None,
-        )
+    user = get_request_user()
 
-    if not get_jwt_identity():
+    if user is None:
         return dict(
             authenticated=False,
             current_user=None,
         )
     else:
-        user = get_current_user()
-
         return dict(
             authenticated=True,
             current_user=json.dumps({
@@ -82,28 +203,14 @@ def current_user_context():
 
 @app.route('/')
 @jwt_required()
+@conditional_on_epoch('DashboardPage.html')
 def default_route():
-    groups = db.session.query(Group) \
-        .join(GroupMembership) \
-        .filter(GroupMembership.user_id == current_user.id) \
-        .all()
-
-    ms1 = aliased(GroupMembership)
-    ms2 = aliased(GroupMembership)
-
-    users = db.session.query(User) \
-        .join(
-            (ms1, ms1.user_id == User.id),
-            (ms2, ms1.group_id == ms2.group_id),
-        ) \
-        .filter(GroupMembership.user_id == current_user.id) \
-        .all()
+    groups = serialize_items([ membership.group for membership in get_user_memberships(current_user) ], BOOTSTRAP_GROUP_FIELDS)
 
     return render_component(
         'DashboardPage',
         breadcrumb=[Link('Dashboard', 'default_route')],
         groups=groups,
-        users=users,
     )
 
 @app.route('/login')
@@ -116,12 +223,11 @@ def login_view():
 
 @app.route('/login', methods=['POST'])
 def login_post():
-    print(db.session.execute(select([User.username])))
-
     username = request.form['username']
     password = request.form['password']
 
-    user = authenticate(username, password)
+    with instrumentation.phase('auth'):
+        user = authenticate(username, password)
 
     if user is None:
         return render_component('LoginPage', error='Invalid credentials.', username=username)
@@ -159,29 +265,110 @@ class Link:
 @app.route('/file/<id>', defaults={'name': None})
 @app.route('/file/<id>/<name>')
 def download_file(id, name):
-    query = File.id == id
+    query = File.query.filter(File.id == id)
 
     if name is not None:
-        query = query and File.name == name
+        query = query.filter(File.name == name)
 
-    file = File.query.filter(query).first()
+    file = query.first()
 
-    if not file:
+    if not file or not blob_store.exists(file.digest):
         return 'File Not Found', 404
-    
-    response = make_response(file.data)
-    response.headers.set('Content-Type', file.mimetype)
-    response.headers.set('Content-Disposition', 'attachment', filename=file.name or f'file_{file.id}')
 
-    return response
+    # Blobs are immutable, so their digest doubles as a strong ETag. Ranges and
+    # conditional requests are handled by send_file, which streams the file
+    # from disk (or hands it to the server with USE_X_SENDFILE).
+    return send_file(
+        blob_store.path(file.digest),
+        mimetype=file.mimetype,
+        as_attachment=True,
+        download_name=file.name or f'file_{file.id}',
+        conditional=True,
+        etag=file.digest,
+        max_age=app.config.get('FILE_CACHE_MAX_AGE', 86400),
+    )
+
+@app.route('/file', methods=['POST'])
+@jwt_required()
+def upload_file():
+    max_size = app.config.get('UPLOAD_MAX_SIZE', 20 * 1024 * 1024)
+
+    if request.content_length is not None and request.content_length > max_size:
+        return jsonify({
+            'status': 'error',
+            'error': f'Upload exceeds the maximum size of {max_size} bytes',
+        }), 413
+
+    # Either a multipart form with a 'file' field, or the raw file as the
+    # request body, which is copied to storage without being buffered.
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            return jsonify({
+                'status': 'error',
+                'error': 'No file provided',
+                'field': 'file',
+            }), 400
+
+        upload = request.files['file']
+        stream, mimetype, name = upload.stream, upload.mimetype, upload.filename
+    else:
+        stream, mimetype, name = request.stream, request.mimetype, request.args.get('name')
+
+    try:
+        digest, size = blob_store.put(stream, max_size=max_size)
+    except BlobTooLarge as e:
+        return jsonify({
+            'status': 'error',
+            'error': str(e),
+        }), 413
+
+    file = File(
+        uploader=current_user,
+        owner=current_user,
+        digest=digest,
+        size=size,
+        mimetype=mimetype or 'application/octet-stream',
+        name=name or None,
+    )
+
+    if app.config.get('THUMBNAILS_ON_UPLOAD', True):
+        thumbnailer.generate_all(file)
+
+    db.session.add(file)
+    db.session.commit()
+
+    return jsonify({
+        'status': 'success',
+        'file': dict(id=file.id, **file.toJSON()),
+    })
+
+@app.route('/file/<id>/thumbnail/<int:size>')
+def file_thumbnail(id, size):
+    file = File.query.filter(File.id == id).first()
+
+    if not file or not blob_store.exists(file.digest):
+        return 'File Not Found', 404
+
+    thumbnail = thumbnailer.get(file, size)
+
+    if thumbnail is None:
+        return 'Thumbnail Not Available', 404
+
+    path, mimetype = thumbnail
+
+    return send_file(
+        path,
+        mimetype=mimetype,
+        conditional=True,
+        etag=f'{file.digest}-{size}',
+        max_age=app.config.get('FILE_CACHE_MAX_AGE', 86400),
+    )
 
 @app.route('/groups')
 @jwt_required()
+@conditional_on_epoch('GroupListPage.html')
 def groups():
-    groups = db.session.query(Group) \
-        .join(GroupMembership) \
-        .filter(GroupMembership.user_id == current_user.id) \
-        .all()
+    groups = serialize_items([ membership.group for membership in get_user_memberships(current_user) ], BOOTSTRAP_GROUP_FIELDS)
 
     return render_component(
         'GroupListPage',
@@ -192,26 +379,37 @@ def groups():
 @app.route('/groups/<id>')
 @jwt_required()
 def group_details(id):
-    membership = GroupMembership.query.filter(
-        and_(
-            GroupMembership.user_id == current_user.id,
-            GroupMembership.group_id == id,
+    memberships = get_user_memberships(current_user)
+    membership = next((m for m in memberships if str(m.group_id) == id), None)
+
+    if membership is None and not is_visible_group(current_user, id):
+        return render_component(
+            'NotFoundPage',
+            message='No such group found.',
         )
-    ).first()
 
-    group = Group.query.filter(Group.id == id).first()
+    group = membership.group if membership else Group.query.filter(Group.id == id).first()
 
-    groups = db.session.query(Group) \
-        .join(GroupMembership) \
-        .filter(GroupMembership.user_id == current_user.id) \
-        .all()
+    groups = serialize_items([ m.group for m in memberships ], BOOTSTRAP_GROUP_FIELDS)
+
+    limit = app.config.get('PAGE_SIZE', 50)
+    members, members_next = split_page(
+        get_group_members(group.id, limit=limit + 1, fields=MEMBER_FIELDS),
+        limit,
+        lambda membership: membership.user_id,
+    )
 
     return render_component(
         'GroupDetailsPage',
         breadcrumb=[Link('Groups', 'groups'), Link(group.name, 'group_details', id=id)],
         groups=groups,
-        group=group,
-        membership=membership,
+        group=serialize(group, BOOTSTRAP_GROUP_FIELDS, LIST_ITEM_DEPTH),
+        members=serialize_items(members, MEMBER_FIELDS),
+        members_next=members_next,
+        permissions={
+            permission: check_permissions([ (current_user, group) ], permission).popitem()[1]
+            for permission in PERMISSIONS
+        },
     )
 
 @app.route('/user/<username>')
@@ -228,11 +426,23 @@ def user_details(username):
             message='No such user found.',
         )
 
+    # Only the first page of direct reports is inlined, the deeper levels and
+    # further pages are loaded from api_subordinates.
+    limit = app.config.get('PAGE_SIZE', 50)
+    subordinates, subordinates_next = split_page(
+        get_direct_reports(user.id, limit=limit + 1, fields=SUBORDINATE_FIELDS),
+        limit,
+        lambda subordinate: subordinate.id,
+    )
+
     return render_component(
         'UserDetails',
         breadcrumb=[Link('Users'), Link(user.username, 'user_details', username=user.username)],
         user = user,
         groups = user.groups,
+        supervisors = reporting_lines.supervisors(user.id),
+        subordinates = serialize_items(subordinates, SUBORDINATE_FIELDS),
+        subordinates_next = subordinates_next,
     )
 
 @app.route('/user/<username>', methods=['POST'])
@@ -247,6 +457,11 @@ def user_edit(username):
         )
     
 
+    username = request.form.get('username')
+
+    if username is not None and username != user.username and username_taken(username):
+        return username_taken_error(username)
+
     for field in ('name', 'username', 'email'):
         if field in request.form:
             setattr(user, field, request.form[field])
@@ -262,30 +477,18 @@ def create_user_form(group):
 
     return render_component('CreateUserPage', group=group)
 
+def username_taken(username):
+    return db.session.query(User.query.filter(User.username == username).exists()).scalar()
+
+def username_taken_error(username):
+    return jsonify({
+        'status': 'error',
+        'error': f"Username '{username}' is already taken",
+        'field': 'username',
+    })
+
 def has_group_permission(group, user, permission):
-    print(group, isinstance(group, Group))
-    if not isinstance(group, Group):
-        group = Group.query.filter(Group.id == group).first()
-
-    if isinstance(user, int):
-        user = User.query.filter(User.id == user).first()
-    elif isinstance(user, str):
-        user = User.query.filter(User.username == user).first()
-
-    while group:
-        membership = GroupMembership.query \
-            .filter(GroupMembership.group == group and GroupMembership.user == user) \
-            .first()
-
-        if not membership:
-            return False
-        
-        if getattr(membership, permission) is True:
-            return True
-        
-        group = group.parent
-    
-    return False
+    return check_permissions([ (user, group) ], permission).popitem()[1]
 
 @app.route('/user', methods=['POST'])
 @jwt_required()
@@ -295,22 +498,39 @@ def create_user():
 
     new_user = User()
 
-    for group in json.get('groups', []):
-        group_def = Group.query.filter(Group.id == group['id']).first()
+    requested = json.get('groups', [])
+
+    # IDs may also be given as numeric strings.
+    for group in requested:
+        try:
+            group['id'] = int(group['id'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({
+                'status': 'error',
+                'field': 'groups',
+                'error': 'Expected an object with the ID of the group',
+            })
+
+    group_defs = Group.query.filter(Group.id.in_([ group['id'] for group in requested ])).all()
+    group_defs = { group.id: group for group in group_defs }
+    allowed = allowed_groups(user, group_defs, 'create_users')
+
+    for group in requested:
+        group_def = group_defs.get(group['id'])
+
+        if group_def is None:
+            return jsonify({
+                'status': 'error',
+                'field': 'groups',
+                'error': f"Group with ID {group['id']} does not exist",
+            })
 
-        if not has_group_permission(group_def, user, 'create_users'):
+        if group_def.id not in allowed:
             return jsonify({
                 'status': 'error',
                 'field': 'groups',
                 'error': f"User '{user.username}' (ID {user.id}) has no 'create_user' permission in group '{group_def.name}' (ID {group_def.id})",
             })
-        
-        new_user.groups.append(GroupMembership(
-            user=new_user,
-            group=group_def,
-            create_users=group.get('create_users', False),
-            manage_users=group.get('manage_users', False),
-        ))
     
     if 'username' not in json or not json['username']:
         return jsonify({
@@ -319,6 +539,9 @@ def create_user():
             'field': 'username',
         })
 
+    if username_taken(json['username']):
+        return username_taken_error(json['username'])
+
     if 'supervisor' in json:
         supervisor = User.query.filter(User.id == json['supervisor']).first()
 
@@ -331,13 +554,29 @@ def create_user():
         
         new_user.supervisor = supervisor
     
-    if 'photo' in json:
+    if 'photo' in json and 'id' in json['photo']:
+        avatar = File.query.filter(File.id == json['photo']['id'], File.uploader_id == user.id).first()
+
+        if not avatar:
+            return jsonify({
+                'status': 'error',
+                'error': f"Invalid photo: no file with ID {json['photo']['id']} uploaded by you",
+                'field': 'photo',
+            })
+
+        avatar.owner = new_user
+        new_user.avatar = avatar
+
+    elif 'photo' in json:
         try:
             avatar = File(uploader=user, owner=new_user)
 
-            avatar.data = base64.b64decode(json['photo']['data'])
+            avatar.digest, avatar.size = blob_store.put(base64.b64decode(json['photo']['data']))
             avatar.mimetype = json['photo']['mimetype']
 
+            if app.config.get('THUMBNAILS_ON_UPLOAD', True):
+                thumbnailer.generate_all(avatar)
+
             new_user.avatar = avatar
 
         except Exception:
@@ -354,6 +593,16 @@ def create_user():
     new_user.role = json.get('role')
     new_user.password = b""
 
+    # Memberships are attached last, as they cascade the new user into the
+    # session and any query issued after that would autoflush it half-built.
+    for group in requested:
+        new_user.groups.append(GroupMembership(
+            user=new_user,
+            group=group_defs[group['id']],
+            create_users=group.get('create_users', False),
+            manage_users=group.get('manage_users', False),
+        ))
+
     db.session.add(new_user)
     db.session.commit()
 
@@ -362,24 +611,672 @@ def create_user():
         'user': new_user.toJSON(),
     })
 
-def get_user_known_groups(user):
-    groups = list(map(lambda m: m.group, user.groups))
-    active = list(groups)
-    new_active = []
-
-    while len(active) > 0:
-        for group in active:
-            for subgroup in group.subgroups:
-                if subgroup not in groups:
-                    groups.append(subgroup)
-                    new_active.append(subgroup)
-            
-            active = new_active
-            new_active = []
-    
-    return groups
+@app.route('/users/import', methods=['POST'])
+@jwt_required()
+def bulk_create_users():
+    format = IMPORT_FORMATS.get(request.args.get('format') or request.mimetype)
+
+    if format is None:
+        return jsonify({
+            'status': 'error',
+            'error': 'Expected CSV (text/csv) or JSON Lines (application/x-ndjson) data',
+        }), 415
+
+    user = get_current_user()
+    chunk_size = request.args.get('chunk_size', DEFAULT_CHUNK_SIZE, type=int)
+
+    rows = read_rows(io.TextIOWrapper(request.stream, encoding='utf-8', newline=''), format)
+    results = import_users(rows, lambda groups: allowed_groups(user, groups, 'create_users'), chunk_size)
+
+    return Response(
+        stream_with_context(json.dumps(result) + '\n' for result in results),
+        mimetype='application/x-ndjson',
+    )
+
+@app.route('/api/export/<table>')
+@jwt_required()
+def api_export(table):
+    # Streams the users, groups or memberships of the groups in which the user
+    # may manage users, as ?format=csv (the default) or jsonl, and gzip
+    # compressed with ?compress=gzip.
+    if table not in EXPORT_TABLES:
+        return jsonify({
+            'status': 'error',
+            'error': f"No such export, expected one of {', '.join(EXPORT_TABLES)}",
+        }), 404
+
+    format = request.args.get('format', 'csv')
+    compress = request.args.get('compress')
+
+    if format not in EXPORT_FORMATS:
+        return jsonify({
+            'status': 'error',
+            'error': f"Expected one of {', '.join(EXPORT_FORMATS)}",
+            'field': 'format',
+        }), 400
+
+    if compress not in (None, 'gzip'):
+        return jsonify({
+            'status': 'error',
+            'error': 'Only gzip compression is supported',
+            'field': 'compress',
+        }), 400
+
+    groups = permitted_groups_query(get_request_user(), 'manage_users')
+    filename = f'{table}.{format}' + ('.gz' if compress else '')
+
+    return Response(
+        stream_with_context(export(table, format, compress == 'gzip', groups)),
+        mimetype='application/gzip' if compress else EXPORT_FORMATS[format],
+        headers={ 'Content-Disposition': f'attachment; filename="{filename}"' },
+    )
+
+def co_member_groups(user, include_subgroups=False):
+    mine = aliased(GroupMembership)
+
+    if include_subgroups:
+        groups = db.session.query(GroupClosure.descendant_id) \
+            .join(mine, mine.group_id == GroupClosure.ancestor_id) \
+            .filter(mine.user_id == user.id)
+    else:
+        groups = db.session.query(mine.group_id) \
+            .filter(mine.user_id == user.id)
+
+    return groups.subquery()
+
+def is_co_member(user, include_subgroups=False):
+    # The condition co_member_ids selects on, as a function of a user ID
+    # column, for queries that check it row by row.
+    def condition(user_id):
+        theirs = aliased(GroupMembership)
+
+        return and_(
+            user_id != user.id,
+            db.session.query(theirs.user_id)
+                .filter(theirs.user_id == user_id, theirs.group_id.in_(co_member_groups(user, include_subgroups)))
+                .exists(),
+        )
+
+    return condition
+
+def is_known_group(user):
+    # Whether a group is one of the user's groups or below one, as a function
+    # of a group ID column, like is_co_member.
+    mine = db.session.query(GroupMembership.group_id) \
+        .filter(GroupMembership.user_id == user.id) \
+        .subquery()
+
+    def condition(group_id):
+        return db.session.query(GroupClosure.ancestor_id) \
+            .filter(GroupClosure.descendant_id == group_id, GroupClosure.ancestor_id.in_(mine)) \
+            .exists()
+
+    return condition
+
+def is_visible_group(user, group_id):
+    return db.session.query(Group.query.filter(Group.id == group_id, is_known_group(user)(Group.id)).exists()).scalar()
+
+def co_member_ids(user, include_subgroups=False, after=None, limit=None):
+    # IDs of the users sharing a group with the given user, in ascending order.
+    # The query starts from the user's own memberships, so its cost depends on
+    # the size of those groups rather than on the number of users.
+    theirs = aliased(GroupMembership)
+
+    query = db.session.query(theirs.user_id) \
+        .filter(theirs.group_id.in_(co_member_groups(user, include_subgroups)), theirs.user_id != user.id)
+
+    if after is not None:
+        query = query.filter(theirs.user_id > after)
+
+    query = query.distinct().order_by(theirs.user_id)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+def get_co_members(user, include_subgroups=False, after=None, limit=None, fields=None):
+    ids = co_member_ids(user, include_subgroups, after, limit).subquery()
+
+    return User.query \
+        .filter(User.id.in_(ids)) \
+        .options(*eager_load(User, LIST_ITEM_DEPTH, fields)) \
+        .order_by(User.id) \
+        .all()
+
+def get_user_known_groups(user, after=None, limit=None, fields=None):
+    query = Group.query \
+        .join(GroupClosure, GroupClosure.descendant_id == Group.id) \
+        .join(GroupMembership, GroupMembership.group_id == GroupClosure.ancestor_id) \
+        .filter(GroupMembership.user_id == user.id) \
+        .options(*eager_load(Group, LIST_ITEM_DEPTH, fields))
+
+    if after is not None:
+        query = query.filter(Group.id > after)
+
+    return query.distinct().order_by(Group.id).limit(limit).all()
+
+def get_group_members(group_id, after=None, limit=None, fields=None):
+    query = GroupMembership.query \
+        .filter(GroupMembership.group_id == group_id) \
+        .options(*eager_load(GroupMembership, LIST_ITEM_DEPTH, fields))
+
+    if after is not None:
+        query = query.filter(GroupMembership.user_id > after)
+
+    return query.order_by(GroupMembership.user_id).limit(limit).all()
+
+def get_direct_reports(user_id, after=None, limit=None, fields=None):
+    query = User.query \
+        .filter(User.supervisor_id == user_id) \
+        .options(*eager_load(User, LIST_ITEM_DEPTH, fields))
+
+    if after is not None:
+        query = query.filter(User.id > after)
+
+    return query.order_by(User.id).limit(limit).all()
+
+# List endpoints use keyset pagination: every page is ordered by an integer
+# key, and the cursor returned with a page is the key of its last item. The
+# next page is requested with ?after=<cursor>.
+
+# List items are serialized one level down, so that the objects they refer
+# to come without relationships of their own. At depth 0 a group holds every
+# membership of its parent and subgroups, and a membership holds its group,
+# which makes the size of a page grow with the square of the group size.
+LIST_ITEM_DEPTH = 1
+
+# Fields of list items when ?fields= is not given.
+BOOTSTRAP_GROUP_FIELDS = ('id', 'name', 'parent', 'subgroups')
+MEMBER_FIELDS = ('user', 'create_users', 'manage_users')
+SUBORDINATE_FIELDS = ('id', 'name', 'username')
+
+def serialize_items(items, fields=None):
+    with instrumentation.phase('serialization'):
+        return [ serialize(item, fields, LIST_ITEM_DEPTH) for item in items ]
+
+def split_page(items, limit, key):
+    # Pages are loaded with limit + 1 rows, the extra one only telling
+    # whether there is a next page.
+    if len(items) > limit:
+        return items[:limit], key(items[limit - 1])
+
+    return items, None
+
+def requested_fields(model, default=None):
+    # The ?fields= subset of the public attributes of model, or default when
+    # none are asked for, and the requested fields that are not public.
+    fields = request.args.get('fields')
+    fields = tuple(field for field in fields.split(',') if field) if fields else default
+
+    return fields, [ field for field in fields or () if field not in model.__public__ ]
+
+def unknown_fields_error(unknown):
+    return jsonify({
+        'status': 'error',
+        'error': f'Unknown fields: {", ".join(unknown)}',
+        'field': 'fields',
+    }), 400
+
+def requested_limit(default):
+    limit = request.args.get('limit', default, type=int)
+
+    return max(1, min(limit, app.config.get('MAX_PAGE_SIZE', 500)))
+
+def paginated_response(model, load, key, default_fields=None):
+    fields, unknown = requested_fields(model, default_fields)
+
+    if unknown:
+        return unknown_fields_error(unknown)
+
+    limit = requested_limit(app.config.get('PAGE_SIZE', 50))
+
+    items, cursor = split_page(load(request.args.get('after', type=int), limit + 1, fields), limit, key)
+
+    return jsonify({
+        'items': serialize_items(items, fields),
+        'next': cursor,
+    })
+
+@app.route('/metrics')
+def metrics():
+    if instrumentation.metrics is None:
+        return 'Not Found', 404
+
+    cache = permission_cache.stats()
+    bootstrap = bootstrap_cache.stats()
+
+    return Response(instrumentation.metrics.render([
+        ('tsoha_permission_cache_hits_total', 'counter', 'Permission cache hits.', cache['hits']),
+        ('tsoha_permission_cache_misses_total', 'counter', 'Permission cache misses.', cache['misses']),
+        ('tsoha_permission_cache_evictions_total', 'counter', 'Permission cache evictions.', cache['evictions']),
+        ('tsoha_permission_cache_entries', 'gauge', 'Entries in the permission cache.', cache['size']),
+        ('tsoha_bootstrap_cache_hits_total', 'counter', 'Bootstrap fragment cache hits.', bootstrap['hits']),
+        ('tsoha_bootstrap_cache_misses_total', 'counter', 'Bootstrap fragment cache misses.', bootstrap['misses']),
+        ('tsoha_bootstrap_cache_entries', 'gauge', 'Entries in the bootstrap fragment cache.', bootstrap['size']),
+    ]), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/users')
+@jwt_required()
+@conditional_on_epoch()
+def api_users():
+    user = get_request_user()
+    include_subgroups = app.config.get('CO_MEMBERS_INCLUDE_SUBGROUPS', False)
+
+    return paginated_response(
+        User,
+        lambda after, limit, fields: get_co_members(user, include_subgroups, after, limit, fields),
+        lambda user: user.id,
+    )
+
+@app.route('/api/groups')
+@jwt_required()
+@conditional_on_epoch()
+def api_groups():
+    user = get_request_user()
+
+    return paginated_response(
+        Group,
+        lambda after, limit, fields: get_user_known_groups(user, after, limit, fields),
+        lambda group: group.id,
+        BOOTSTRAP_GROUP_FIELDS,
+    )
+
+def search_response(model, index, scope, default_fields=None):
+    fields, unknown = requested_fields(model, default_fields)
+
+    if unknown:
+        return unknown_fields_error(unknown)
+
+    ids = search(index, request.args.get('q', ''), scope, requested_limit(app.config.get('SEARCH_LIMIT', 10)))
+
+    found = model.query \
+        .filter(model.id.in_(ids)) \
+        .options(*eager_load(model, LIST_ITEM_DEPTH, fields)) \
+        .all()
+
+    found = { obj.id: obj for obj in found }
+
+    return jsonify({
+        'items': serialize_items([ found[id] for id in ids if id in found ], fields),
+    })
+
+@app.route('/api/users/search')
+@jwt_required()
+@conditional_on_epoch()
+def api_search_users():
+    # Searches among the same users that /api/users lists.
+    user = get_request_user()
+    scope = is_co_member(user, app.config.get('CO_MEMBERS_INCLUDE_SUBGROUPS', False))
+
+    return search_response(User, 'user_search', scope)
+
+@app.route('/api/groups/search')
+@jwt_required()
+@conditional_on_epoch()
+def api_search_groups():
+    # Searches among the same groups that /api/groups lists.
+    return search_response(Group, 'group_search', is_known_group(get_request_user()), BOOTSTRAP_GROUP_FIELDS)
+
+@app.route('/api/groups/<int:id>/members')
+@jwt_required()
+def api_group_members(id):
+    # Only the members of the user's own groups and the groups below them
+    # are listed, the same groups that /api/groups lists. Other groups are
+    # reported as missing.
+    if not is_visible_group(get_request_user(), id):
+        return jsonify({
+            'status': 'error',
+            'error': f'Group {id} does not exist',
+        }), 404
+
+    return paginated_response(
+        GroupMembership,
+        lambda after, limit, fields: get_group_members(id, after, limit, fields),
+        lambda membership: membership.user_id,
+        MEMBER_FIELDS,
+    )
+
+def parse_decision_request(item):
+    # {"user": ID or username, "group": ID, "action": one of ACTIONS}
+    if not isinstance(item, dict):
+        return None
+
+    user, group, action = item.get('user'), item.get('group'), item.get('action')
+
+    if isinstance(user, str) and user.isdigit():
+        user = int(user)
+
+    if isinstance(group, str) and group.isdigit():
+        group = int(group)
+
+    if not isinstance(user, (int, str)) or not isinstance(group, int) or action not in ACTIONS:
+        return None
+
+    return user, group, action
+
+def invalid_decision_error(field):
+    return jsonify({
+        'status': 'error',
+        'error': f"Expected user (ID or username), group (ID) and action (one of {', '.join(ACTIONS)})",
+        'field': field,
+    }), 400
+
+def forbidden_decision(decisions):
+    # Index of the first decision the user of the token may not ask for, or
+    # None. Anyone may ask about themselves, which needs no queries, but
+    # asking about others needs the 'manage_users' permission in the group.
+    # On these endpoints the current user is the ID from the token, see
+    # SNAPSHOT_AUTHENTICATED_ENDPOINTS.
+    caller = get_current_user()
+    snapshot = authorizer.current()
+    others = [
+        (index, group)
+        for index, (user, group, _action) in enumerate(decisions)
+        if snapshot.user_id(user) != caller
+    ]
+
+    if not others:
+        return None
+
+    allowed = check_permissions([ (caller, group) for _index, group in others ], 'manage_users')
+
+    for index, group in others:
+        if not allowed[caller, group]:
+            return index
+
+    return None
+
+def forbidden_decision_error(field):
+    return jsonify({
+        'status': 'error',
+        'error': "Asking about other users requires the 'manage_users' permission in the group",
+        'field': field,
+    }), 403
+
+@app.route('/api/decision')
+@jwt_required()
+def api_decision():
+    # Whether ?user= may perform ?action= in ?group=, answered from the
+    # authorization snapshot without touching the database.
+    decision = parse_decision_request(request.args.to_dict())
+
+    if decision is None:
+        return invalid_decision_error('action')
+
+    if forbidden_decision([ decision ]) is not None:
+        return forbidden_decision_error('user')
+
+    authorizer.record([ decision ])
+    (allowed,), version = authorizer.decide_many([ decision ])
+
+    return jsonify({
+        'allowed': allowed,
+        'version': version,
+    })
+
+@app.route('/api/decisions', methods=['POST'])
+@jwt_required()
+def api_decisions():
+    # Batch of decisions, {"requests": [{"user": ..., "group": ..., "action":
+    # ...}, ...]}, all answered from the same snapshot.
+    json = request.get_json(silent=True)
+    items = json.get('requests') if isinstance(json, dict) else None
+
+    if not isinstance(items, list):
+        return invalid_decision_error('requests')
+
+    decisions = [ parse_decision_request(item) for item in items ]
+
+    if None in decisions:
+        return invalid_decision_error(f'requests[{decisions.index(None)}]')
+
+    forbidden = forbidden_decision(decisions)
+
+    if forbidden is not None:
+        return forbidden_decision_error(f'requests[{forbidden}]')
+
+    authorizer.record(decisions)
+    allowed, version = authorizer.decide_many(decisions)
+
+    return jsonify({
+        'decisions': allowed,
+        'version': version,
+    })
+
+@app.route('/api/users/<int:id>/reporting-lines')
+@jwt_required()
+def api_reporting_lines(id):
+    # The supervisor chain and the subordinate tree of the user, down to
+    # ?depth= levels. Both list users with their depth and say whether a
+    # cycle was found or the depth limit cut them short.
+    if not db.session.query(User.query.filter(User.id == id).exists()).scalar():
+        return jsonify({
+            'status': 'error',
+            'error': f'User {id} does not exist',
+        }), 404
+
+    depth = request.args.get('depth', type=int)
+
+    return jsonify({
+        'supervisors': reporting_lines.supervisors(id, depth),
+        'subordinates': reporting_lines.subordinates(id, depth),
+    })
+
+@app.route('/api/users/<int:id>/reporting-lines/subordinates')
+@jwt_required()
+def api_subordinates(id):
+    # The direct reports of the user, a page at a time. The levels below are
+    # loaded with the same endpoint for each of them.
+    if not db.session.query(User.query.filter(User.id == id).exists()).scalar():
+        return jsonify({
+            'status': 'error',
+            'error': f'User {id} does not exist',
+        }), 404
+
+    return paginated_response(
+        User,
+        lambda after, limit, fields: get_direct_reports(id, after, limit, fields),
+        lambda user: user.id,
+        SUBORDINATE_FIELDS,
+    )
+
+def invalid_change_error(e):
+    return jsonify({
+        'status': 'error',
+        'error': str(e),
+        'field': e.field,
+    }), 400
+
+def floor_not_found_error(id):
+    return jsonify({
+        'status': 'error',
+        'error': f'Floor {id} does not exist',
+    }), 404
+
+@app.route('/api/buildings')
+@jwt_required()
+def api_buildings():
+    buildings = Building.query \
+        .options(joinedload(Building.floors)) \
+        .order_by(Building.id) \
+        .all()
+
+    return jsonify({
+        'items': serialize_items(buildings),
+    })
+
+# Floor plans are not tied to any group, so editing them is left to those
+# who may manage users in at least one group.
+FLOOR_PLAN_PERMISSION = 'manage_users'
+
+def floor_plan_permission_error():
+    return jsonify({
+        'status': 'error',
+        'error': f"Editing floor plans requires the '{FLOOR_PLAN_PERMISSION}' permission in a group",
+    }), 403
+
+@app.route('/api/buildings', methods=['POST'])
+@jwt_required()
+def api_create_building():
+    if not has_permission_in_any_group(get_request_user(), FLOOR_PLAN_PERMISSION):
+        return floor_plan_permission_error()
+
+    try:
+        values = parse_building(request.get_json(silent=True))
+    except InvalidChange as e:
+        return invalid_change_error(e)
+
+    building = Building(name=values['name'])
+
+    for floor in values['floors']:
+        building.floors.append(Floor(**floor))
+
+    db.session.add(building)
+    db.session.commit()
+
+    return jsonify({
+        'status': 'success',
+        'building': serialize(building),
+    })
+
+@app.route('/api/buildings/<int:id>/floors', methods=['POST'])
+@jwt_required()
+def api_create_floor(id):
+    if not has_permission_in_any_group(get_request_user(), FLOOR_PLAN_PERMISSION):
+        return floor_plan_permission_error()
+
+    building = Building.query.get(id)
+
+    if building is None:
+        return jsonify({
+            'status': 'error',
+            'error': f'Building {id} does not exist',
+        }), 404
+
+    try:
+        values = parse_floor(request.get_json(silent=True), None)
+    except InvalidChange as e:
+        return invalid_change_error(e)
+
+    floor = Floor(building=building, **values)
+
+    db.session.add(floor)
+    db.session.commit()
+
+    return jsonify({
+        'status': 'success',
+        'floor': serialize(floor),
+    })
+
+@app.route('/api/floors/<int:id>/rooms')
+@jwt_required()
+def api_floor_rooms(id):
+    # Rooms of one floor, only those overlapping ?bbox=min_x,min_y,max_x,max_y
+    # if given. With ?since=<version> only the rooms changed after that
+    # version are returned, wherever they are, along with the IDs of deleted
+    # ones, so that clients can catch up without reloading the floor.
+    floor = Floor.query.get(id)
+
+    if floor is None:
+        return floor_not_found_error(id)
+
+    # The response only changes with the version of the floor.
+    etag = hashlib.sha1(f'{floor.version}:{request.full_path}'.encode('utf-8')).hexdigest()
+
+    if not is_resource_modified(request.environ, etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        box = parse_box(request.args['bbox']) if 'bbox' in request.args else None
+    except InvalidChange as e:
+        return invalid_change_error(e)
+
+    since = request.args.get('since', type=int)
+    deleted = []
+
+    if since is not None:
+        rooms, deleted = changed_rooms(floor, since)
+        rooms = serialize_items(rooms)
+    elif box is not None:
+        rooms = spatial_index.get(floor).within(box)
+    else:
+        rooms = spatial_index.get(floor).all()
+
+    response = jsonify({
+        'floor': serialize(floor),
+        'items': rooms,
+        'deleted': deleted,
+    })
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+
+    return response
+
+@app.route('/api/floors/<int:id>/rooms/at')
+@jwt_required()
+def api_floor_rooms_at(id):
+    floor = Floor.query.get(id)
+
+    if floor is None:
+        return floor_not_found_error(id)
+
+    x = request.args.get('x', type=float)
+    y = request.args.get('y', type=float)
+
+    if x is None or y is None:
+        return jsonify({
+            'status': 'error',
+            'error': 'Both coordinates are required',
+            'field': 'x' if x is None else 'y',
+        }), 400
+
+    return jsonify({
+        'items': spatial_index.get(floor).at(x, y),
+    })
+
+@app.route('/api/floors/<int:id>/rooms', methods=['POST'])
+@jwt_required()
+def api_save_floor_rooms(id):
+    # Saves a diff of the rooms, see apply_changes().
+    if not has_permission_in_any_group(get_request_user(), FLOOR_PLAN_PERMISSION):
+        return floor_plan_permission_error()
+
+    floor = Floor.query.get(id)
+
+    if floor is None:
+        return floor_not_found_error(id)
+
+    try:
+        version, created = apply_changes(floor, request.get_json(silent=True))
+    except InvalidChange as e:
+        return invalid_change_error(e)
+    except VersionConflict as e:
+        db.session.rollback()
+
+        return jsonify({
+            'status': 'error',
+            'error': str(e),
+            'field': 'version',
+            'version': db.session.query(Floor.version).filter(Floor.id == id).scalar(),
+        }), 409
+
+    db.session.commit()
+
+    return jsonify({
+        'status': 'success',
+        'version': version,
+        'created': created,
+    })
 
 def router():
+    # The URL map does not change after startup, so build the map only once.
+    if 'router' in app.extensions:
+        return app.extensions['router']
+
     router_map = '{'
 
     for rule in app.url_map.iter_rules():
@@ -391,7 +1288,7 @@ def router():
         rule_expr = rule.rule
 
         for argument in rule.arguments:
-            rule_expr = rule_expr.replace('<' + argument + '>', '${' + argument + '}')
+            rule_expr = re.sub('<(?:[^:<>]+:)?' + argument + '>', '${' + argument + '}', rule_expr)
         
         builder += ') => `' + rule_expr + '`'
 
@@ -399,79 +1296,79 @@ def router():
     
     router_map += '}'
 
+    app.extensions['router'] = router_map
+    app.extensions['router_etag'] = hashlib.sha1(router_map.encode('utf-8')).hexdigest()
+
     return router_map
 
-class DepthWrapper:
-    def __init__(self, depth, value):
-        self.depth = depth
-        self.value = value
+def router_etag():
+    router()
 
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        depth = 0
+    return app.extensions['router_etag']
 
-        if isinstance(obj, DepthWrapper):
-            depth = obj.depth
-            obj = obj.value
+@app.context_processor
+def router_context():
+    return dict(router_url=url_for('router_script', v=router_etag()))
+
+@app.route('/router.js')
+def router_script():
+    response = make_response(f'window._router = {router()};')
+    response.headers.set('Content-Type', 'application/javascript')
+    response.set_etag(router_etag())
+
+    # Versioned URLs never change content, anything else is revalidated.
+    if request.args.get('v') == router_etag():
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
 
-        if hasattr(obj, 'toJSON') and callable(obj.toJSON):
-            d = {}
+    return response.make_conditional(request)
 
-            delta = obj.__depth__ if hasattr(obj, '__depth__') else 1
+app.json_encoder = CustomEncoder
 
-            for key, value in obj.toJSON(shallow=depth > 1).items():
-                if isinstance(value, (tuple, list, set)):
-                    d[key] = [ DepthWrapper(depth + delta, v) for v in value ]
-                else:
-                    d[key] = DepthWrapper(depth + delta, value)
-            
-            return d
+def bootstrap_fragment(user, limit, include_subgroups):
+    # The parts of the page bootstrap that depend only on what the user can
+    # see. Only the first page of each list is inlined into the page, the rest
+    # is fetched from the API using the cursors.
+    users, users_next = split_page(get_co_members(user, include_subgroups, limit=limit + 1), limit, lambda user: user.id)
 
-        return obj
+    groups, groups_next = split_page(
+        get_user_known_groups(user, limit=limit + 1, fields=BOOTSTRAP_GROUP_FIELDS),
+        limit,
+        lambda group: group.id,
+    )
 
-app.json_encoder = CustomEncoder
+    with instrumentation.phase('serialization'):
+        return {
+            'user': serialize(user),
+            'groups': serialize_items(groups, BOOTSTRAP_GROUP_FIELDS),
+            'groups_next': groups_next,
+            'users': serialize_items(users),
+            'users_next': users_next,
+        }
 
 def render_component(component, breadcrumb=[], **props):
-    user = None
-
-    try:
-        verify_jwt_in_request(optional=True)
-    except Exception as _e:
-        pass
-    else:
-        if get_jwt_identity():
-            user = get_current_user()
-    
-    users = []
+    user = get_request_user()
+    fragment = dict(user=None, groups=[], groups_next=None, users=[], users_next=None)
 
     if user:
-        u = aliased(User)
-        gm1 = aliased(GroupMembership)
-        gm2 = aliased(GroupMembership)
-
-        stmt = db.session.query(gm1, gm2, User) \
-            .filter(gm1.user_id == user.id) \
-            .join(gm2, gm2.group_id == gm1.group_id) \
-            .join(User, gm2.user_id == User.id) \
-            .filter(User.id != user.id)
-
-        print(stmt)
-
-        users = User.query.select_from(gm1, gm2) \
-            .filter(gm1.user_id == user.id) \
-            .join(gm2, gm2.group_id == gm1.group_id) \
-            .join(User, gm2.user_id == User.id) \
-            .all()
-
-        print(list(users))
-
-    bootstrap = {
-        'breadcrumb': breadcrumb,
-        'router': router(),
-        'user': user,
-        'props': props,
-        'groups': get_user_known_groups(user) if user else [],
-        'users': users,
-    }
-
-    return render_template(component + '.html', bootstrap=json.dumps(bootstrap, cls=CustomEncoder))
\ No newline at end of file
+        limit = app.config.get('PAGE_SIZE', 50)
+        include_subgroups = app.config.get('CO_MEMBERS_INCLUDE_SUBGROUPS', False)
+        epoch, _changed_at = get_authorization_epoch(user)
+
+        fragment = bootstrap_cache.get_or_set(
+            (user.id, epoch, limit, include_subgroups),
+            lambda: bootstrap_fragment(user, limit, include_subgroups),
+        )
+
+    with instrumentation.phase('serialization'):
+        bootstrap = json.dumps({
+            'breadcrumb': serialize(breadcrumb),
+            'props': serialize(props),
+            **fragment,
+        })
+
+    with instrumentation.phase('template'):
+        return render_template(component + '.html', bootstrap=bootstrap)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import asyncio
+
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+from tsoha import configure_app
+
+# Request bodies are read by the event loop before the request is handed to
+# a thread, and kept in memory up to this size.
+MAX_MEMORY_BODY_SIZE = 1024 * 1024
+
+FILE_BLOCK_SIZE = 64 * 1024
+
+class FileResponse:
+    # Stands in for wsgi.file_wrapper, so that files returned by send_file()
+    # are recognized and streamed by the event loop.
+
+    def __init__(self, file, block_size=FILE_BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.block_size), b'')
+
+    def close(self):
+        self.file.close()
+
+def _environ(scope, body, length):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileResponse,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+
+        environ[name] = value
+
+    # The whole body has been read, which also covers chunked requests that
+    # come without a Content-Length.
+    environ['CONTENT_LENGTH'] = str(length)
+
+    return environ
+
+def _start_message(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [ (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers ],
+    }
+
+class AsgiApp:
+    # Serves the Flask app to an ASGI server such as uvicorn. The event loop
+    # accepts connections and reads request bodies, and each request is then
+    # handled on a bounded pool of threads, which is also where its SQLite
+    # statements run. Files returned by send_file(), like downloads, are
+    # streamed by the event loop once the view returns, so that a slow client
+    # does not hold on to one of the threads.
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='tsoha-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+
+        with SpooledTemporaryFile(max_size=MAX_MEMORY_BODY_SIZE) as body:
+            while True:
+                message = await receive()
+
+                if message['type'] == 'http.disconnect':
+                    return
+
+                body.write(message.get('body', b''))
+
+                if not message.get('more_body'):
+                    break
+
+            length = body.tell()
+            body.seek(0)
+
+            response = await loop.run_in_executor(self.executor, self.run, scope, body, length, loop, send)
+
+        if response is not None:
+            start, file = response
+            await self.send_file(start, file, loop, send)
+
+    def run(self, scope, body, length, loop, send):
+        # Runs the WSGI app on one of the threads. Responses are sent from here
+        # as they are produced, except for files, which are returned together
+        # with the response headers for the event loop to send.
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            started['message'] = _start_message(status, headers)
+
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.app(_environ(scope, body, length), start_response)
+
+        if isinstance(result, FileResponse):
+            return started['message'], result
+
+        try:
+            for chunk in result:
+                if not chunk:
+                    continue
+
+                if not started.get('sent'):
+                    started['sent'] = True
+                    call(started['message'])
+
+                call({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+
+            if not started.get('sent'):
+                started['sent'] = True
+                call(started['message'])
+
+            call({ 'type': 'http.response.body' })
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def send_file(self, start, file, loop, send):
+        try:
+            await send(start)
+
+            while True:
+                # Reads from the disk are short, so they use the loop's default
+                # executor rather than the request threads.
+                chunk = await loop.run_in_executor(None, file.file.read, file.block_size)
+
+                if not chunk:
+                    break
+
+                await send({ 'type': 'http.response.body', 'body': chunk, 'more_body': True })
+
+            await send({ 'type': 'http.response.body' })
+        finally:
+            file.close()
+
+def create_asgi_app():
+    # Entry point for ASGI servers, e.g.
+    # uvicorn --factory tsoha.asgi:create_asgi_app
+    app = configure_app()
+
+    return AsgiApp(app, app.config.get('ASGI_THREADS'))
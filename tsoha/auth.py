@@ -1,24 +1,143 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from tsoha import db
-from tsoha.models import User
+from flask import g, has_request_context
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity, get_current_user
+from sqlalchemy.orm import joinedload
 
+from tsoha import db, instrumentation
+from tsoha.models import User, GroupMembership
+
+import os
 import bcrypt
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password, hashed):
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        return False
+
+class PasswordHasher:
+    # Runs bcrypt on a bounded pool of threads (bcrypt releases the GIL) or
+    # processes, so that hashing neither starves other requests of CPU nor
+    # limits bulk operations to a single core.
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.mode = 'thread'
+        self.workers = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config.get('BCRYPT_ROUNDS', 12)
+        self.mode = app.config.get('PASSWORD_HASH_EXECUTOR', 'thread')
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS') or os.cpu_count()
+
+    def get_executor(self):
+        if self.executor is None and self.mode:
+            with self.lock:
+                if self.executor is None:
+                    executor = ProcessPoolExecutor if self.mode == 'process' else ThreadPoolExecutor
+                    self.executor = executor(max_workers=self.workers)
+
+        return self.executor
+
+    def run(self, fn, *args):
+        executor = self.get_executor()
+
+        if executor is None:
+            return fn(*args)
+
+        return executor.submit(fn, *args).result()
+
+    def hash(self, password):
+        return self.run(_hashpw, password.encode('utf-8'), self.rounds)
+
+    def hash_many(self, passwords):
+        passwords = [ password.encode('utf-8') for password in passwords ]
+        executor = self.get_executor()
+
+        if executor is None:
+            return [ _hashpw(password, self.rounds) for password in passwords ]
+
+        return list(executor.map(_hashpw, passwords, [ self.rounds ] * len(passwords)))
+
+    def check(self, password, hashed):
+        return self.run(_checkpw, password.encode('utf-8'), hashed)
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like $2b$<rounds>$<salt and digest>
+        return int(hashed.split(b'$')[2]) != self.rounds
+
+password_hasher = PasswordHasher()
 
 def authenticate(username, password):
     user = User.query.filter(User.username == username).first()
 
-    if user is None:
+    if user is None or not user.password:
         return None
 
-    if not bcrypt.checkpw(password.encode('utf-8'), user.password):
+    if not password_hasher.check(password, user.password):
         return None
 
+    # Upgrade hashes made with an outdated work factor while the plaintext
+    # password is at hand.
+    if password_hasher.needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+
     return user
 
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return password_hasher.hash(password)
+
+def request_cache(name):
+    # Memoization dictionary that lives for the duration of the current request.
+    if not has_request_context():
+        return {}
+
+    return g.setdefault(name, {})
 
 def get_user(user_id):
-    return User.query.filter(User.id == user_id).first()
+    users = request_cache('users')
+
+    if user_id not in users:
+        users[user_id] = User.query.filter(User.id == user_id).first()
+
+    return users[user_id]
+
+def get_request_user():
+    if not has_request_context():
+        return None
+
+    if 'request_user' not in g:
+        with instrumentation.phase('auth'):
+            try:
+                verify_jwt_in_request(optional=True)
+            except Exception:
+                g.request_user = None
+            else:
+                g.request_user = get_current_user() if get_jwt_identity() else None
+
+    return g.request_user
+
+def get_user_memberships(user):
+    memberships = request_cache('memberships')
+
+    if user.id not in memberships:
+        memberships[user.id] = GroupMembership.query \
+            .options(joinedload(GroupMembership.group)) \
+            .filter(GroupMembership.user_id == user.id) \
+            .all()
+
+    return memberships[user.id]
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+
+from tsoha import db
+from tsoha.models import User, Group, GroupMembership, GroupClosure
+from tsoha.permissions import PERMISSIONS
+from tsoha.snapshot_format import PermissionTable
+
+# Actions that decisions can be asked for. 'member' is granted by belonging
+# to the group or to any group above it, the same way the permissions are
+# inherited.
+ACTIONS = ('member',) + PERMISSIONS
+
+# Memberships are stored as bit flags of the actions they grant.
+BITS = { action: 1 << index for index, action in enumerate(ACTIONS) }
+
+# Users per statement, to stay well below the bound parameter limit.
+CHUNK_SIZE = 500
+
+def _chunks(ids):
+    ids = list(ids)
+
+    return (ids[start:start + CHUNK_SIZE] for start in range(0, len(ids), CHUNK_SIZE))
+
+def _load_memberships(connection, users=None):
+    table = GroupMembership.__table__
+    query = select([ table.c.user_id, table.c.group_id, *[ table.c[permission] for permission in PERMISSIONS ] ])
+    queries = [ query ] if users is None else [ query.where(table.c.user_id.in_(chunk)) for chunk in _chunks(users) ]
+
+    memberships = {}
+
+    for row in chain.from_iterable(connection.execute(query) for query in queries):
+        flags = BITS['member']
+
+        for permission in PERMISSIONS:
+            if row[permission]:
+                flags |= BITS[permission]
+
+        memberships.setdefault(row.user_id, {})[row.group_id] = flags
+
+    return memberships
+
+def _load_usernames(connection, users=None):
+    table = User.__table__
+    query = select([ table.c.username, table.c.id ])
+    queries = [ query ] if users is None else [ query.where(table.c.id.in_(chunk)) for chunk in _chunks(users) ]
+
+    return dict(row for query in queries for row in connection.execute(query))
+
+def _load_ancestors(connection):
+    closure = GroupClosure.__table__
+    ancestors = {}
+
+    query = select([ closure.c.descendant_id, closure.c.ancestor_id ]) \
+        .order_by(closure.c.descendant_id, closure.c.depth)
+
+    for descendant, ancestor in connection.execute(query):
+        ancestors.setdefault(descendant, []).append(ancestor)
+
+    return { group: tuple(ids) for group, ids in ancestors.items() }
+
+class Snapshot:
+    # Immutable copy of everything access decisions depend on: the
+    # memberships of each user as {group ID: flags}, the ancestors of each
+    # group, nearest first, and the user IDs by username. A decision walks up
+    # from the group until it finds a membership granting the action.
+
+    __slots__ = ('version', 'built_at', 'usernames', 'user_ids', 'memberships', 'ancestors')
+
+    def __init__(self, version, built_at, usernames, memberships, ancestors):
+        self.version = version
+        self.built_at = built_at
+        self.usernames = usernames
+        self.user_ids = frozenset(usernames.values())
+        self.memberships = memberships
+        self.ancestors = ancestors
+
+    @classmethod
+    def build(cls, connection, version=1):
+        return cls(
+            version,
+            time.monotonic(),
+            _load_usernames(connection),
+            _load_memberships(connection),
+            _load_ancestors(connection),
+        )
+
+    def updated(self, connection, users=(), groups=False):
+        # A new snapshot with the given users, and if groups is true the group
+        # hierarchy, reloaded. Everything else is shared with this one.
+        users = set(users)
+        usernames = self.usernames
+        memberships = self.memberships
+
+        if users:
+            loaded = _load_memberships(connection, users)
+
+            memberships = dict(memberships)
+
+            for user in users:
+                if user in loaded:
+                    memberships[user] = loaded[user]
+                else:
+                    memberships.pop(user, None)
+
+            usernames = { name: id for name, id in usernames.items() if id not in users }
+            usernames.update(_load_usernames(connection, users))
+
+        ancestors = _load_ancestors(connection) if groups else self.ancestors
+
+        return Snapshot(self.version + 1, self.built_at, usernames, memberships, ancestors)
+
+    def has_user(self, user_id):
+        return user_id in self.user_ids
+
+    def user_id(self, user):
+        return self.usernames.get(user) if isinstance(user, str) else user
+
+    def decide(self, user, group, action):
+        memberships = self.memberships.get(self.user_id(user))
+
+        if not memberships:
+            return False
+
+        bit = BITS[action]
+
+        for ancestor in self.ancestors.get(group, ()):
+            if memberships.get(ancestor, 0) & bit:
+                return True
+
+        return False
+
+def permission_table(connection):
+    # The effective permissions of every user in every group, in the form
+    # written by 'flask export-snapshot'. Each group with a membership
+    # contributes a mask of itself and all the groups below it.
+    snapshot = Snapshot.build(connection)
+    groups = sorted(connection.execute(select([ Group.__table__.c.id, Group.__table__.c.name ])))
+    indexes = { id: index for index, (id, _name) in enumerate(groups) }
+
+    masks = {}
+
+    for descendant, ancestors in snapshot.ancestors.items():
+        for ancestor in ancestors:
+            masks[ancestor] = masks.get(ancestor, 0) | (1 << indexes[descendant])
+
+    rows = {}
+
+    for id in snapshot.user_ids:
+        bits = [ 0 ] * len(ACTIONS)
+
+        for group, flags in snapshot.memberships.get(id, {}).items():
+            for index, action in enumerate(ACTIONS):
+                if flags & BITS[action]:
+                    bits[index] |= masks.get(group, 0)
+
+        rows[id] = tuple(bits)
+
+    users = [ (id, username) for username, id in snapshot.usernames.items() ]
+
+    return PermissionTable(ACTIONS, groups, users, rows)
+
+class Authorizer:
+    # Answers access decisions from a Snapshot held in memory of each worker
+    # process. Commits that change memberships, usernames or the group
+    # hierarchy build a new snapshot with only the affected parts reloaded,
+    # and replace the old one with a single assignment, so readers never wait
+    # for a rebuild. Changes committed by other processes are picked up by a
+    # full rebuild in the background once the snapshot is older than
+    # AUTHORIZATION_SNAPSHOT_TTL seconds. With DECISION_TRACE set, decision
+    # requests are appended to that file for 'flask replay-decisions'.
+
+    def __init__(self, app=None):
+        self.app = None
+        self.snapshot = None
+        self.ttl = None
+        self.trace = None
+        self.lock = threading.Lock()
+        self.trace_lock = threading.Lock()
+        self.refreshing = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.get('AUTHORIZATION_SNAPSHOT_TTL', 60)
+
+        if app.config.get('DECISION_TRACE'):
+            self.trace = open(app.config['DECISION_TRACE'], 'a', encoding='utf-8', buffering=1)
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._apply_changes)
+        event.listen(db.session, 'after_rollback', self._discard_changes)
+
+    def current(self):
+        snapshot = self.snapshot
+
+        if snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    with db.get_engine(self.app).connect() as connection:
+                        self.snapshot = Snapshot.build(connection)
+
+                return self.snapshot
+
+        if self.ttl is not None and not self.refreshing and time.monotonic() - snapshot.built_at > self.ttl:
+            self.refreshing = True
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+        return snapshot
+
+    def decide(self, user, group, action):
+        return self.current().decide(user, group, action)
+
+    def decide_many(self, requests):
+        # Decisions for (user, group, action) triples, all from the same
+        # snapshot, and the version of that snapshot.
+        snapshot = self.current()
+
+        return [ snapshot.decide(user, group, action) for user, group, action in requests ], snapshot.version
+
+    def refresh(self, users=None, groups=False):
+        # Rebuilds the snapshot, or with users given only reloads those users
+        # and, if groups is true, the group hierarchy.
+        with self.lock:
+            with db.get_engine(self.app).connect() as connection:
+                if users is None or self.snapshot is None:
+                    version = self.snapshot.version + 1 if self.snapshot is not None else 1
+                    self.snapshot = Snapshot.build(connection, version)
+                else:
+                    self.snapshot = self.snapshot.updated(connection, users, groups)
+
+    def changed(self, session, users=(), groups=False):
+        # Marks users, or the group hierarchy, to be reloaded once the session
+        # commits. Statements that bypass the ORM have to call this.
+        users = set(users)
+
+        if users or groups:
+            pending = session.info.setdefault('authorization_changes', [set(), False])
+            pending[0].update(users)
+            pending[1] = pending[1] or groups
+
+    def record(self, requests):
+        if self.trace is None:
+            return
+
+        line = json.dumps([ dict(user=user, group=group, action=action) for user, group, action in requests ])
+
+        with self.trace_lock:
+            self.trace.write(line + '\n')
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            self.app.logger.exception('Rebuilding the authorization snapshot failed')
+        finally:
+            self.refreshing = False
+
+    def _collect_changes(self, session, flush_context):
+        users, groups = set(), False
+        dirty = session.dirty
+
+        for obj in chain(session.new, dirty, session.deleted):
+            if isinstance(obj, GroupMembership):
+                users.update(v for v in inspect(obj).attrs.user_id.history.sum() if v is not None)
+            elif isinstance(obj, User):
+                if obj not in dirty or inspect(obj).attrs.username.history.has_changes():
+                    users.add(obj.id)
+            elif isinstance(obj, Group):
+                attrs = inspect(obj).attrs
+
+                if obj not in dirty or attrs.parent.history.has_changes() or attrs.parent_id.history.has_changes():
+                    groups = True
+
+        self.changed(session, users, groups)
+
+    def _apply_changes(self, session):
+        pending = session.info.pop('authorization_changes', None)
+
+        if pending is None or self.snapshot is None:
+            return
+
+        try:
+            self.refresh(*pending)
+        except Exception:
+            # The next decision builds a new snapshot from scratch instead.
+            self.app.logger.exception('Updating the authorization snapshot failed')
+            self.snapshot = None
+
+    def _discard_changes(self, session):
+        session.info.pop('authorization_changes', None)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from itertools import count
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+# Load generator for comparing ways of serving the app, e.g. a threaded WSGI
+# server against tsoha.asgi. Every client thread keeps one connection open
+# and sends GET requests back to back. replay() times recorded requests
+# handled in-process instead.
+
+def _client(host, port, paths, headers, counter, total, latencies, errors):
+    connection = HTTPConnection(host, port, timeout=60)
+
+    while True:
+        index = next(counter)
+
+        if index >= total:
+            break
+
+        path = paths[index % len(paths)]
+        start = time.perf_counter()
+
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except OSError:
+            errors.append(path)
+            connection.close()
+            connection = HTTPConnection(host, port, timeout=60)
+            continue
+
+        latencies.append(time.perf_counter() - start)
+
+        if response.status >= 400:
+            errors.append(path)
+
+    connection.close()
+
+def run_load(urls, headers=None, clients=16, requests=1000):
+    # Sends requests GET requests spread over the URLs, which must all point
+    # to the same server, from clients concurrent connections.
+    location = urlsplit(urls[0])
+    paths = [ urlsplit(url)._replace(scheme='', netloc='').geturl() or '/' for url in urls ]
+
+    counter = count()
+    latencies = []
+    errors = []
+
+    threads = [
+        threading.Thread(
+            target=_client,
+            args=(location.hostname, location.port or 80, paths, headers or {}, counter, requests, latencies, errors),
+        )
+        for _ in range(clients)
+    ]
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, time.perf_counter() - start, len(errors))
+
+def replay(batches, handle, repeat=1):
+    # Calls handle with every recorded batch in turn, repeat times over, and
+    # times each call.
+    latencies = []
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        for batch in batches:
+            call_start = time.perf_counter()
+            handle(batch)
+            latencies.append(time.perf_counter() - call_start)
+
+    return summarize(latencies, time.perf_counter() - start)
+
+def summarize(latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0
+
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        seconds=elapsed,
+        throughput=len(latencies) / elapsed if elapsed else 0,
+        p50=percentile(0.5),
+        p95=percentile(0.95),
+        p99=percentile(0.99),
+    )
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import threading
+
+from itertools import chain
+from collections import OrderedDict
+
+from flask import g, has_request_context
+from sqlalchemy import event, inspect, select
+from werkzeug.utils import import_string
+
+from tsoha import db
+from tsoha.models import Group, GroupMembership, GroupClosure
+
+class MemoryBackend:
+    # Keys are tuples, indexed by their first two items, which for the
+    # permission cache are the user and group IDs. Invalidation only visits
+    # the entries it removes, instead of scanning all of them under the lock.
+
+    def __init__(self, max_size, ttl, **_options):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.by_user = {}
+        self.by_group = {}
+        self.lock = threading.Lock()
+
+    def _index(self, key):
+        self.by_user.setdefault(key[0], set()).add(key)
+        self.by_group.setdefault(key[1], set()).add(key)
+
+    def _remove(self, key):
+        del self.entries[key]
+
+        for index, id in ((self.by_user, key[0]), (self.by_group, key[1])):
+            keys = index[id]
+            keys.discard(key)
+
+            if not keys:
+                del index[id]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires = entry
+
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        return self.set_many([ (key, value) ])
+
+    def set_many(self, items):
+        evicted = 0
+
+        with self.lock:
+            expires = time.monotonic() + self.ttl
+
+            for key, value in items:
+                if key not in self.entries:
+                    self._index(key)
+
+                self.entries[key] = (value, expires)
+                self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+
+        return evicted
+
+    def invalidate(self, users, groups):
+        with self.lock:
+            keys = set()
+
+            for index, ids in ((self.by_user, users), (self.by_group, groups)):
+                for id in ids:
+                    keys.update(index.get(id, ()))
+
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_user.clear()
+            self.by_group.clear()
+
+    def size(self):
+        return len(self.entries)
+
+class FileBackend:
+    # SQLite file shared by every worker process pointed at the same path.
+
+    def __init__(self, max_size, ttl, path=None, **_options):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path or os.path.join(os.getcwd(), 'permission_cache.db')
+        self.local = threading.local()
+
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                user_id INTEGER NOT NULL,
+                group_id INTEGER NOT NULL,
+                permission TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (user_id, group_id, permission)
+            );
+            CREATE INDEX IF NOT EXISTS entries_group_id ON entries (group_id);
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+        ''')
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self.local.connection = connection
+
+        return connection
+
+    def get(self, key):
+        now = time.time()
+
+        row = self.connection.execute(
+            'SELECT value, expires FROM entries WHERE user_id = ? AND group_id = ? AND permission = ?',
+            key,
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        if row[1] < now:
+            self.connection.execute('DELETE FROM entries WHERE user_id = ? AND group_id = ? AND permission = ?', key)
+            return None
+
+        self.connection.execute(
+            'UPDATE entries SET accessed = ? WHERE user_id = ? AND group_id = ? AND permission = ?',
+            (now, *key),
+        )
+
+        return bool(row[0])
+
+    def set(self, key, value):
+        return self.set_many([ (key, value) ])
+
+    def set_many(self, items):
+        now = time.time()
+
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+            [ (*key, int(value), now + self.ttl, now) for key, value in items ],
+        )
+
+        cursor = self.connection.execute('''
+            DELETE FROM entries WHERE rowid IN (
+                SELECT rowid FROM entries ORDER BY accessed
+                LIMIT max(0, (SELECT COUNT(*) FROM entries) - ?)
+            )
+        ''', (self.max_size,))
+
+        return cursor.rowcount
+
+    def invalidate(self, users, groups):
+        for column, ids in (('user_id', users), ('group_id', groups)):
+            ids = list(ids)
+
+            if ids:
+                placeholders = ', '.join('?' * len(ids))
+                self.connection.execute(f'DELETE FROM entries WHERE {column} IN ({placeholders})', ids)
+
+    def clear(self):
+        self.connection.execute('DELETE FROM entries')
+
+    def size(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'file': FileBackend,
+}
+
+class PermissionCache:
+    # Changes are invalidated in this process and in the backend when they
+    # are flushed and again when they commit. The 'memory' backend is
+    # private to each worker process, so the other workers keep answering
+    # from their entries until those expire after PERMISSION_CACHE_TTL
+    # seconds. Deployments with several worker processes that need revoked
+    # permissions to take effect at once should use the shared 'file' backend.
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('PERMISSION_CACHE_BACKEND', 'memory')
+
+        if not backend:
+            return
+
+        backend = BACKENDS[backend] if backend in BACKENDS else import_string(backend)
+
+        self.backend = backend(
+            max_size=app.config.get('PERMISSION_CACHE_SIZE', 10000),
+            ttl=app.config.get('PERMISSION_CACHE_TTL', 30),
+            path=app.config.get('PERMISSION_CACHE_PATH'),
+        )
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._apply_changes)
+        event.listen(db.session, 'after_rollback', self._apply_changes)
+
+    def get(self, user_id, group_id, permission):
+        if self.backend is None:
+            return None
+
+        value = self.backend.get((user_id, group_id, permission))
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, user_id, group_id, permission, value):
+        if self.backend is not None:
+            self.evictions += self.backend.set((user_id, group_id, permission), value)
+
+    def get_many(self, keys):
+        # The values of those of the (user ID, group ID, permission) keys that
+        # are cached.
+        if self.backend is None:
+            return {}
+
+        found = {}
+
+        for key in keys:
+            value = self.backend.get(key)
+
+            if value is not None:
+                found[key] = value
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def set_many(self, items):
+        # Stores (key, value) pairs, evicting old entries once for all of them.
+        if self.backend is not None and items:
+            self.evictions += self.backend.set_many(items)
+
+    def invalidate(self, users=(), groups=()):
+        users, groups = set(users), set(groups)
+
+        if self.backend is not None and (users or groups):
+            self.backend.invalidate(users, groups)
+
+        if has_request_context():
+            g.pop('permissions', None)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=self.backend.size() if self.backend is not None else 0,
+        )
+
+    def _collect_changes(self, session, flush_context):
+        users, groups = set(), set()
+        dirty = session.dirty
+
+        for obj in chain(session.new, dirty, session.deleted):
+            if isinstance(obj, GroupMembership):
+                users.update(v for v in inspect(obj).attrs.user_id.history.sum() if v is not None)
+            elif isinstance(obj, Group):
+                attrs = inspect(obj).attrs
+
+                if obj in dirty and not (attrs.parent.history.has_changes() or attrs.parent_id.history.has_changes()):
+                    continue
+
+                groups.add(obj.id)
+
+        if not (users or groups):
+            return
+
+        # Moving a group changes the effective permissions of its whole subtree.
+        if groups:
+            closure = GroupClosure.__table__
+
+            descendants = session.connection().execute(
+                select([closure.c.descendant_id]).where(closure.c.ancestor_id.in_(groups))
+            )
+
+            groups.update(row[0] for row in descendants)
+
+        pending = session.info.setdefault('permission_invalidations', (set(), set()))
+        pending[0].update(users)
+        pending[1].update(groups)
+
+        self.invalidate(users, groups)
+
+    def _apply_changes(self, session):
+        pending = session.info.pop('permission_invalidations', None)
+
+        # Invalidate again once the transaction ends: another worker may have
+        # cached the old state before our commit, or this session may have
+        # cached flushed state that was then rolled back.
+        if pending is not None:
+            self.invalidate(*pending)
+
+class FragmentCache:
+    # Serialized parts of pages, in memory of each worker process. Keys
+    # include everything the content depends on, such as the authorization
+    # epoch of the user, so entries are never invalidated but only replaced
+    # by ones under a newer key, and expire or get evicted.
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        size = app.config.get('BOOTSTRAP_CACHE_SIZE', 1000)
+
+        if size:
+            self.backend = MemoryBackend(max_size=size, ttl=app.config.get('BOOTSTRAP_CACHE_TTL', 300))
+
+    def get_or_set(self, key, build):
+        if self.backend is None:
+            return build()
+
+        value = self.backend.get(key)
+
+        if value is None:
+            self.misses += 1
+            value = build()
+            self.backend.set(key, value)
+        else:
+            self.hits += 1
+
+        return value
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            size=self.backend.size() if self.backend is not None else 0,
+        )
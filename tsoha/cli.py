@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from importlib import import_module
+
+from flask.cli import AppGroup
+
+class LazyGroup(AppGroup):
+    # Command group that imports the module registering its commands the
+    # first time the commands are listed or looked up, so that creating the
+    # app for a server does not import them at all.
+
+    def __init__(self, module, **kwargs):
+        super().__init__(**kwargs)
+
+        self.module = module
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            import_module(self.module)
+
+    def list_commands(self, ctx):
+        self.load()
+        return super().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        self.load()
+        return super().get_command(ctx, name)
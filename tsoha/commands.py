@@ -1,14 +1,42 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import json
+import time
 import bcrypt
 import click
 
 from flask.cli import with_appcontext
+from flask_jwt_extended import create_access_token
 
-from tsoha import db, app
+from urllib.parse import urlencode
+
+from tsoha import db, app, authorizer, parse_decision_request
 from tsoha.auth import hash_password
-from tsoha.models import User, Group, GroupMembership
+from tsoha.models import User, Group, GroupMembership, rebuild_search_index
+from tsoha.models.group import rebuild_group_closure
+from tsoha.provisioning import DEFAULT_CHUNK_SIZE, read_rows, import_users
+from tsoha.permissions import effective_permissions
+from tsoha.query_plans import hot_queries, explain, full_scans
+from tsoha.benchmark import run_load, replay
+from tsoha.authorization import permission_table
+from tsoha.snapshot_format import SnapshotFile, write_snapshot, write_delta
+from tsoha.export import EXPORT_TABLES, EXPORT_FORMATS, export
+from tsoha.serialization import serialize, eager_load
+
+@click.command(name='init-db')
+@with_appcontext
+def init_db():
+    from flask_migrate import stamp
+
+    # The migrations only alter an existing schema, so a new database gets
+    # the current schema directly and is marked as fully migrated.
+    db.create_all()
+    stamp()
+
+    print('Created the database schema.')
 
 @click.command(name='create-user')
 @click.argument('username')
@@ -28,11 +56,17 @@ def create_user(username, password, name):
 @click.command(name='create-group')
 @click.argument('name')
 @click.option('--parent')
+@with_appcontext
 def create_group(name, parent=None):
     group = Group(name=name)
 
     if parent is not None:
         p = Group.query.filter(Group.name == parent).first()
+
+        if p is None:
+            print(f'No group named \'{parent}\' exists.')
+            sys.exit(1)
+
         group.parent = p
 
     db.session.add(group)
@@ -56,6 +90,358 @@ def add_to_group(group, username, create_users=False, manage_users=False):
 
     print(f'Added user \'{ username }\' to group \'{ group }\'.')
 
+@click.command(name='rebuild-group-closure')
+@with_appcontext
+def rebuild_closure():
+    rebuild_group_closure(db.session.connection())
+    db.session.commit()
+
+    print('Rebuilt the group hierarchy closure table.')
+
+@click.command(name='rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    rebuild_search_index(db.session.connection())
+    db.session.commit()
+
+    print('Rebuilt the user and group search indexes.')
+
+@click.command(name='import-users')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']))
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True)
+@with_appcontext
+def import_users_command(file, format=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    if format is None:
+        format = 'csv' if os.path.splitext(file.name)[1].lower() == '.csv' else 'jsonl'
+
+    created = 0
+    failed = 0
+
+    for result in import_users(read_rows(file, format), chunk_size=chunk_size):
+        print(json.dumps(result))
+
+        if result['status'] == 'success':
+            created += 1
+        else:
+            failed += 1
+
+    print(f'Created {created} users, {failed} rows failed.', file=sys.stderr)
+
+@click.command(name='check-query-plans')
+@click.option('--verbose', is_flag=True)
+@with_appcontext
+def check_query_plans(verbose=False):
+    failures = 0
+
+    for name, query in hot_queries():
+        plan = explain(query)
+        scans = full_scans(plan)
+
+        if scans:
+            failures += 1
+            print(f'FAIL {name}: ' + '; '.join(scans))
+        else:
+            print(f'ok   {name}')
+
+        if verbose:
+            for step in plan:
+                print(f'       {step}')
+
+    if failures:
+        print(f'{failures} queries fall back to a full table scan.')
+        sys.exit(1)
+
+@click.command(name='benchmark')
+@click.argument('urls', nargs=-1, required=True)
+@click.option('--user', help='Username to send requests as.')
+@click.option('--clients', default=16, show_default=True)
+@click.option('--requests', default=1000, show_default=True)
+@with_appcontext
+def benchmark(urls, user=None, clients=16, requests=1000):
+    headers = {}
+
+    if user is not None:
+        user = User.query.filter(User.username == user).first()
+
+        if user is None:
+            print('No such user.')
+            sys.exit(1)
+
+        headers['Authorization'] = f'Bearer {create_access_token(identity=user)}'
+
+    result = run_load(list(urls), headers, clients, requests)
+
+    print(f"{result['requests']} requests in {result['seconds']:.2f} s with {clients} clients, {result['errors']} errors")
+    print(f"{result['throughput']:.1f} requests/s")
+    print(f"latency p50 {result['p50'] * 1000:.1f} ms, p95 {result['p95'] * 1000:.1f} ms, p99 {result['p99'] * 1000:.1f} ms")
+
+def print_latencies(label, result, unit=1000, unit_name='ms'):
+    print(f"{label}: {result['requests']} requests in {result['seconds']:.2f} s, {result['throughput']:.1f} requests/s")
+    print(f"  latency p50 {result['p50'] * unit:.3f} {unit_name}, p95 {result['p95'] * unit:.3f} {unit_name}, p99 {result['p99'] * unit:.3f} {unit_name}")
+
+@click.command(name='benchmark-group-hierarchy')
+@click.option('--depths', default='1,4,16,64', show_default=True, help='Comma-separated tree depths.')
+@click.option('--fanouts', default='1,8,32', show_default=True, help='Comma-separated numbers of subgroups per group.')
+@click.option('--repeat', default=20, show_default=True)
+@with_appcontext
+def benchmark_group_hierarchy(depths, fanouts, repeat=20):
+    # Times keeping the closure table up to date and looking up inherited
+    # permissions on trees of every depth and fan-out. Each tree is a chain
+    # of the given depth whose groups also have fanout - 1 leaf subgroups, and
+    # everything is rolled back afterwards.
+    try:
+        depths = [ int(value) for value in depths.split(',') ]
+        fanouts = [ int(value) for value in fanouts.split(',') ]
+    except ValueError:
+        raise click.ClickException('Depths and fan-outs must be comma-separated integers')
+
+    for depth in depths:
+        for fanout in fanouts:
+            user = User(username='benchmark-group-hierarchy', name='Benchmark', password=b'')
+            roots = [ Group(name='benchmark-root-0'), Group(name='benchmark-root-1') ]
+            chain = [ roots[0] ]
+
+            for level in range(depth):
+                chain.append(Group(name=f'benchmark-{level}', parent=chain[-1]))
+
+                for leaf in range(fanout - 1):
+                    db.session.add(Group(name=f'benchmark-{level}-{leaf}', parent=chain[-2]))
+
+            db.session.add_all([ user, *roots, *chain ])
+            db.session.add(GroupMembership(user=user, group=roots[0], manage_users=True))
+            db.session.flush()
+
+            def add_leaf(_batch):
+                db.session.add(Group(name='benchmark-leaf', parent=chain[-1]))
+                db.session.flush()
+
+            def move_subtree(index):
+                # Everything but the root, back and forth between the roots.
+                chain[1].parent = roots[(index + 1) % 2]
+                db.session.flush()
+
+            def check_permission(_batch):
+                effective_permissions([ user.id ], [ chain[-1].id ])
+
+            batches = list(range(repeat))
+
+            print(f'depth {depth}, fan-out {fanout}, {depth * fanout + 2} groups')
+            print_latencies('  add leaf', replay(batches, add_leaf))
+            print_latencies('  move subtree', replay(batches, move_subtree))
+            print_latencies('  check permission', replay(batches, check_permission))
+
+            db.session.rollback()
+
+def serialize_uncompiled(value, depth=0):
+    # Serializes the way the app did before tsoha.serialization, calling
+    # toJSON on every object and following the same depth rules, as the
+    # baseline for benchmark-serialization.
+    if hasattr(value, 'toJSON') and callable(value.toJSON):
+        delta = value.__depth__ if hasattr(value, '__depth__') else 1
+
+        return {
+            key: [ serialize_uncompiled(v, depth + delta) for v in item ]
+                if isinstance(item, (tuple, list, set)) else serialize_uncompiled(item, depth + delta)
+            for key, item in value.toJSON(shallow=depth > 1).items()
+        }
+
+    if isinstance(value, (tuple, list)):
+        return [ serialize_uncompiled(v) for v in value ]
+
+    return value
+
+@click.command(name='benchmark-serialization')
+@click.option('--users', 'count', default=10000, show_default=True)
+@click.option('--repeat', default=5, show_default=True)
+@with_appcontext
+def benchmark_serialization(count, repeat=5):
+    # Times loading and serializing a list of users to JSON, with the
+    # compiled serializer and eager loading against the old toJSON path.
+    # Every user reports to one of the first tenth, and everything is rolled
+    # back afterwards.
+    users = []
+
+    for index in range(count):
+        users.append(User(
+            username=f'benchmark-serialization-{index}',
+            name=f'Benchmark {index}',
+            email=f'benchmark-{index}@example.com',
+            password=b'',
+            supervisor=users[index // 10] if index >= 10 else None,
+        ))
+
+    db.session.add_all(users)
+    db.session.flush()
+
+    query = User.query.filter(User.username.like('benchmark-serialization-%')).order_by(User.id)
+    output = {}
+
+    def uncompiled(_batch):
+        db.session.expunge_all()
+        output['uncompiled'] = json.dumps(serialize_uncompiled(query.all()))
+
+    def compiled(_batch):
+        db.session.expunge_all()
+        output['compiled'] = json.dumps(serialize(query.options(*eager_load(User)).all()))
+
+    batches = list(range(repeat))
+
+    print(f'{count} users, loaded and serialized')
+    print_latencies('  toJSON', replay(batches, uncompiled))
+    print_latencies('  compiled', replay(batches, compiled))
+
+    loaded = query.options(*eager_load(User)).all()
+
+    print(f'{count} users, serialized only')
+    print_latencies('  toJSON', replay(batches, lambda _batch: json.dumps(serialize_uncompiled(loaded))))
+    print_latencies('  compiled', replay(batches, lambda _batch: json.dumps(serialize(loaded))))
+    print(f"  {len(output['compiled'])} bytes, {'identical' if output['compiled'] == output['uncompiled'] else 'DIFFERENT'} output")
+
+    db.session.rollback()
+
+@click.command(name='replay-decisions')
+@click.argument('trace', type=click.File('r', encoding='utf-8'))
+@click.option('--repeat', default=1, show_default=True, help='Times to replay the trace.')
+@click.option('--user', help='Username to send requests as, to also replay them through the app. Needs manage_users in the groups of the trace.')
+@click.option('--url', help='Base URL of a running server to replay single decisions against.')
+@click.option('--clients', default=16, show_default=True)
+@with_appcontext
+def replay_decisions(trace, repeat=1, user=None, url=None, clients=16):
+    # Replays decision requests recorded with DECISION_TRACE, timing the
+    # snapshot lookups alone, the whole request handled by the app in-process
+    # with --user, and requests to a server over HTTP with --url.
+    batches = []
+
+    for line in trace:
+        if line.strip():
+            batches.append([ parse_decision_request(item) for item in json.loads(line) ])
+
+    batches = [ [ decision for decision in batch if decision is not None ] for batch in batches ]
+    batches = [ batch for batch in batches if batch ]
+
+    if not batches:
+        print('No decisions in the trace.')
+        sys.exit(1)
+
+    print(f'{len(batches)} batches, {sum(len(batch) for batch in batches)} decisions')
+
+    authorizer.current()
+    print_latencies('snapshot', replay(batches, authorizer.decide_many, repeat), 1e6, 'µs')
+
+    if user is None:
+        return
+
+    account = User.query.filter(User.username == user).first()
+
+    if account is None:
+        print('No such user.')
+        sys.exit(1)
+
+    headers = { 'Authorization': f'Bearer {create_access_token(identity=account)}' }
+    client = app.test_client()
+
+    def post(batch):
+        response = client.post('/api/decisions', headers=headers, json={
+            'requests': [ dict(user=user, group=group, action=action) for user, group, action in batch ],
+        })
+
+        if response.status_code != 200:
+            raise click.ClickException(f'Decision request failed with status {response.status_code}')
+
+    print_latencies('app', replay(batches, post, repeat))
+
+    if url is not None:
+        urls = [
+            url.rstrip('/') + '/api/decision?' + urlencode(dict(user=user, group=group, action=action))
+            for batch in batches
+            for user, group, action in batch
+        ]
+
+        result = run_load(urls, headers, clients, len(urls) * repeat)
+
+        print_latencies(f'http ({clients} clients, {result["errors"]} errors)', result)
+
+@click.command(name='export-snapshot')
+@click.argument('output')
+@click.option('--base', help='Earlier snapshot to also write a delta from.')
+@click.option('--delta', help='Where to write the delta, OUTPUT.delta by default.')
+@with_appcontext
+def export_snapshot(output, base=None, delta=None):
+    # Writes the effective permissions for offline readers, see
+    # tsoha/snapshot_format.py for the format and the loader.
+    with db.engine.connect() as connection:
+        table = permission_table(connection)
+
+    # Microseconds since the epoch, but always past the base version, so that
+    # versions keep increasing even if the clock steps back.
+    version = time.time_ns() // 1000
+    base_table = None
+
+    if base is not None:
+        with SnapshotFile(base) as snapshot:
+            if snapshot.is_delta:
+                raise click.ClickException(f'{base} is a delta, not a full snapshot')
+
+            base_version = snapshot.version
+            base_table = snapshot.table()
+
+        version = max(version, base_version + 1)
+
+    write_snapshot(output, table, version)
+
+    print(f'Wrote version {version} with {len(table.users)} users and {len(table.groups)} groups to {output} ({os.path.getsize(output)} bytes).')
+
+    if base_table is None:
+        return
+
+    delta = delta or f'{output}.delta'
+
+    try:
+        changed, removed = write_delta(delta, base_table, table, version, base_version)
+    except ValueError as e:
+        print(f'No delta from version {base_version}: {e}.')
+        return
+
+    print(f'Wrote the delta from version {base_version} with {changed} changed and {removed} removed users to {delta} ({os.path.getsize(delta)} bytes).')
+
+@click.command(name='export')
+@click.argument('table', type=click.Choice(EXPORT_TABLES))
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--format', type=click.Choice(list(EXPORT_FORMATS)))
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output, the default when OUTPUT ends in .gz.')
+@with_appcontext
+def export_command(table, output, format=None, compress=False):
+    # Writes every row of the table, streamed so that memory use does not
+    # grow with the number of rows.
+    name = output.name if isinstance(output.name, str) else ''
+
+    if name.lower().endswith('.gz'):
+        compress = True
+        name = name[:-3]
+
+    if format is None:
+        format = 'jsonl' if os.path.splitext(name)[1].lower() in ('.jsonl', '.ndjson') else 'csv'
+
+    size = 0
+
+    for chunk in export(table, format, compress):
+        output.write(chunk)
+        size += len(chunk)
+
+    print(f'Wrote {size} bytes of {table}.', file=sys.stderr)
+
+app.cli.add_command(init_db)
 app.cli.add_command(create_user)
 app.cli.add_command(create_group)
 app.cli.add_command(add_to_group)
+app.cli.add_command(rebuild_closure)
+app.cli.add_command(rebuild_search_index_command)
+app.cli.add_command(import_users_command)
+app.cli.add_command(check_query_plans)
+app.cli.add_command(benchmark)
+app.cli.add_command(benchmark_group_hierarchy)
+app.cli.add_command(benchmark_serialization)
+app.cli.add_command(replay_decisions)
+app.cli.add_command(export_snapshot)
+app.cli.add_command(export_command)
@@ -6,9 +6,31 @@ import toml
 import sys
 import flask
 
+from sqlalchemy.pool import QueuePool
+
 DEFAULT_ENVIRONMENT = 'development'
 CONFIG_FILE_NAME = 'environment.toml'
 
+READ_ONLY_BIND = 'read_only'
+
+# Flat environment.toml keys and the create_engine() options they map to.
+ENGINE_OPTIONS = {
+    'DATABASE_POOL_SIZE': 'pool_size',
+    'DATABASE_MAX_OVERFLOW': 'max_overflow',
+    'DATABASE_POOL_TIMEOUT': 'pool_timeout',
+    'DATABASE_POOL_RECYCLE': 'pool_recycle',
+    'DATABASE_POOL_PRE_PING': 'pool_pre_ping',
+}
+
+# Pragmas run on every new SQLite connection.
+SQLITE_PRAGMAS = {
+    'SQLITE_JOURNAL_MODE': 'journal_mode',
+    'SQLITE_SYNCHRONOUS': 'synchronous',
+    'SQLITE_CACHE_SIZE': 'cache_size',
+    'SQLITE_MMAP_SIZE': 'mmap_size',
+    'SQLITE_BUSY_TIMEOUT': 'busy_timeout',
+}
+
 def get_config_path():
     config_path = os.environ.get('TSOHA_CONFIG', None)
 
@@ -18,7 +40,7 @@ def get_config_path():
     checking_directory = os.getcwd()
 
     while os.path.exists(checking_directory):
-        config_path = os.path.join(os.getcwd(), CONFIG_FILE_NAME)
+        config_path = os.path.join(checking_directory, CONFIG_FILE_NAME)
 
         if os.path.exists(config_path):
             return config_path
@@ -32,6 +54,42 @@ def get_config_path():
 
     return None
 
+def get_engine_options(config):
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    for key, option in ENGINE_OPTIONS.items():
+        if key in config:
+            options.setdefault(option, config[key])
+
+    if config.get('SQLALCHEMY_DATABASE_URI', '').startswith('sqlite'):
+        connect_args = options.setdefault('connect_args', {})
+
+        # The driver's own timeout is what makes a writer wait for the lock
+        # instead of failing with 'database is locked'.
+        if 'SQLITE_BUSY_TIMEOUT' in config:
+            connect_args.setdefault('timeout', config['SQLITE_BUSY_TIMEOUT'] / 1000)
+
+        # SQLite file databases get a NullPool unless a pool is asked for, and
+        # pooled connections are handed between threads.
+        if options.get('pool_size'):
+            options.setdefault('poolclass', QueuePool)
+            connect_args.setdefault('check_same_thread', False)
+
+    return options
+
+def get_sqlite_pragmas(config):
+    return [ (pragma, config[key]) for key, pragma in SQLITE_PRAGMAS.items() if key in config ]
+
+def get_binds(config):
+    binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+
+    # GET requests read through this database, e.g. a replica, or the same
+    # SQLite file opened a second time with writes disabled.
+    if config.get('DATABASE_READ_URI'):
+        binds.setdefault(READ_ONLY_BIND, config['DATABASE_READ_URI'])
+
+    return binds
+
 def get_config(app=None):
     if app is None:
         env = 'production'
@@ -51,5 +109,7 @@ def get_config(app=None):
 
         if app:
             app.config.update(environments[env])
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config)
+            app.config['SQLALCHEMY_BINDS'] = get_binds(app.config)
 
         return environments[env]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from functools import partial, cached_property
+
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+
+from tsoha.config import READ_ONLY_BIND, get_sqlite_pragmas
+
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def _apply_pragmas(pragmas, dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+
+    for pragma, value in pragmas:
+        value = f"'{value}'" if isinstance(value, str) else int(value)
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+
+    cursor.close()
+
+def _disable_writes(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = 1')
+    cursor.close()
+
+class RoutingSession(SignallingSession):
+    # Sends the reads of GET requests to the read-only bind when one is
+    # configured. Flushes always go to the primary database, so a GET view
+    # that does write still works.
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super().get_bind(mapper, clause)
+
+        if self._flushing or bind is not self.bind or not has_request_context() or request.method not in READ_ONLY_METHODS:
+            return bind
+
+        if READ_ONLY_BIND not in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            return bind
+
+        return get_state(self.app).db.get_engine(self.app, bind=READ_ONLY_BIND)
+
+class Database(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+
+        if engine.dialect.name == 'sqlite':
+            pragmas = get_sqlite_pragmas(self.get_app().config)
+
+            if pragmas:
+                event.listen(engine, 'connect', partial(_apply_pragmas, pragmas))
+
+        return engine
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+
+        if bind == READ_ONLY_BIND and engine.dialect.name == 'sqlite' and not event.contains(engine, 'connect', _disable_writes):
+            event.listen(engine, 'connect', _disable_writes)
+
+        return engine
+
+class Migrations:
+    # Takes the place of Flask-Migrate's state in app.extensions, so that
+    # alembic is only imported when one of the 'flask db' commands runs.
+
+    def __init__(self, app=None, db=None, directory='migrations'):
+        self.db = db
+        self.directory = directory
+        self.configure_args = {}
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None, directory=None):
+        self.db = db or self.db
+        self.directory = directory or self.directory
+
+        app.extensions['migrate'] = self
+
+    @cached_property
+    def migrate(self):
+        from flask_migrate import Migrate
+
+        return Migrate(db=self.db, directory=self.directory)
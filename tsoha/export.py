@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import csv
+import json
+import zlib
+
+from itertools import chain
+from sqlalchemy.orm import aliased
+
+from tsoha import db
+from tsoha.models import User, Group, GroupMembership
+
+EXPORT_TABLES = ('users', 'groups', 'memberships')
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Rows fetched from the cursor at a time, and bytes collected before they
+# are passed on. Together they bound the memory an export takes, however
+# many rows it has.
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+def export_query(table, groups=None):
+    # Query for the rows of one of EXPORT_TABLES, ordered by primary key. With
+    # groups, a subquery of group IDs, only the memberships of those groups,
+    # their members and the groups themselves are included.
+    if table == 'users':
+        supervisor = aliased(User)
+
+        query = db.session.query(
+            User.id, User.username, User.name, User.email, User.role,
+            supervisor.username.label('supervisor'),
+        ).outerjoin(supervisor, supervisor.id == User.supervisor_id)
+
+        if groups is not None:
+            members = db.session.query(GroupMembership.user_id).filter(GroupMembership.group_id.in_(groups))
+            query = query.filter(User.id.in_(members))
+
+        return query.order_by(User.id)
+
+    if table == 'groups':
+        parent = aliased(Group)
+
+        query = db.session.query(Group.id, Group.name, Group.parent_id, parent.name.label('parent')) \
+            .outerjoin(parent, parent.id == Group.parent_id)
+
+        if groups is not None:
+            query = query.filter(Group.id.in_(groups))
+
+        return query.order_by(Group.id)
+
+    if table == 'memberships':
+        query = db.session.query(
+            GroupMembership.user_id, User.username, GroupMembership.group_id, Group.name.label('group'),
+            GroupMembership.create_users, GroupMembership.manage_users,
+        ) \
+            .join(User, User.id == GroupMembership.user_id) \
+            .join(Group, Group.id == GroupMembership.group_id)
+
+        if groups is not None:
+            query = query.filter(GroupMembership.group_id.in_(groups))
+
+        return query.order_by(GroupMembership.user_id, GroupMembership.group_id)
+
+    raise ValueError(f'Unsupported export table: {table}')
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+
+    return value
+
+def csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for row in chain([ columns ], rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow([ _csv_value(value) for value in row ])
+
+        yield buffer.getvalue()
+
+def jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row))) + '\n'
+
+LINE_WRITERS = {
+    'csv': csv_lines,
+    'jsonl': jsonl_lines,
+}
+
+def encode(lines, compress=False, chunk_size=CHUNK_SIZE):
+    # Collects lines into chunks of about chunk_size bytes, gzip compressed
+    # on the fly if compress is true.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    chunk = []
+    size = 0
+
+    def flush():
+        data = b''.join(chunk)
+        chunk.clear()
+
+        return compressor.compress(data) if compressor is not None else data
+
+    for line in lines:
+        data = line.encode('utf-8')
+        chunk.append(data)
+        size += len(data)
+
+        if size >= chunk_size:
+            size = 0
+            data = flush()
+
+            if data:
+                yield data
+
+    data = flush()
+
+    if compressor is not None:
+        data += compressor.flush()
+
+    if data:
+        yield data
+
+def export(table, format, compress=False, groups=None, batch_size=BATCH_SIZE):
+    # The export as a generator of byte chunks. Rows are read from the cursor
+    # batch_size at a time as the chunks are consumed.
+    query = export_query(table, groups)
+    columns = [ column['name'] for column in query.column_descriptions ]
+
+    return encode(LINE_WRITERS[format](columns, query.yield_per(batch_size)), compress)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+
+from tsoha import db
+from tsoha.models import Floor, Room
+
+# Rooms per statement, to stay well below the bound parameter limit.
+CHUNK_SIZE = 500
+
+class InvalidChange(Exception):
+    def __init__(self, error, field):
+        super().__init__(error)
+        self.field = field
+
+class VersionConflict(Exception):
+    def __init__(self, version):
+        super().__init__(f'The floor has changed since version {version}')
+        self.version = version
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def parse_polygon(value, field='polygon'):
+    # Vertices may be given as [x, y] pairs or as {"x": x, "y": y} objects,
+    # the way the editor keeps its points.
+    if not isinstance(value, list) or len(value) < 3:
+        raise InvalidChange('A polygon needs at least three vertices', field)
+
+    polygon = []
+
+    for point in value:
+        if isinstance(point, dict):
+            point = (point.get('x'), point.get('y'))
+
+        if not isinstance(point, (list, tuple)) or len(point) != 2 or not all(_number(v) for v in point):
+            raise InvalidChange(f'Invalid vertex: {point!r}', field)
+
+        polygon.append((float(point[0]), float(point[1])))
+
+    return polygon
+
+def parse_box(value, field='bbox'):
+    # 'min_x,min_y,max_x,max_y' from a query string.
+    try:
+        box = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        box = ()
+
+    if len(box) != 4 or not all(_number(v) for v in box) or box[0] > box[2] or box[1] > box[3]:
+        raise InvalidChange('Expected min_x,min_y,max_x,max_y', field)
+
+    return box
+
+def parse_floor(value, field='floors'):
+    if not isinstance(value, dict):
+        raise InvalidChange('Expected an object with the name and level of the floor', field)
+
+    name = value.get('name') or ''
+    level = value.get('level', 0)
+
+    if not isinstance(name, str):
+        raise InvalidChange('The name of a floor must be a string', field)
+
+    if not _integer(level):
+        raise InvalidChange('The level of a floor must be an integer', field)
+
+    return dict(name=name, level=level)
+
+def parse_building(value):
+    # {"name": "Main", "floors": [{"name": "Ground floor", "level": 0}, ...]}
+    if not isinstance(value, dict):
+        raise InvalidChange('Expected a JSON object', None)
+
+    name = value.get('name')
+
+    if not name or not isinstance(name, str):
+        raise InvalidChange('Name is required', 'name')
+
+    floors = value.get('floors', [])
+
+    if not isinstance(floors, list):
+        raise InvalidChange('Expected a list of floors', 'floors')
+
+    return dict(name=name, floors=[ parse_floor(floor) for floor in floors ])
+
+def _load_rooms(floor, ids):
+    ids = list(ids)
+    rooms = {}
+
+    for start in range(0, len(ids), CHUNK_SIZE):
+        query = Room.query.filter(Room.floor_id == floor.id, Room.id.in_(ids[start:start + CHUNK_SIZE]), ~Room.deleted)
+        rooms.update((room.id, room) for room in query)
+
+    return rooms
+
+def apply_changes(floor, changes):
+    # Applies a diff to the rooms of the floor:
+    #
+    #   {"version": 4,
+    #    "created": [{"key": "a", "name": "A123", "polygon": [[0, 0], ...]}],
+    #    "updated": [{"id": 17, "name": "A124"}, {"id": 18, "polygon": [...]}],
+    #    "deleted": [19, 20]}
+    #
+    # version is the floor version the client has, and the diff is rejected
+    # with VersionConflict if someone else has saved since. Returns the new
+    # version and the IDs of the created rooms by their keys.
+    if not isinstance(changes, dict):
+        raise InvalidChange('Expected a JSON object', None)
+
+    version = changes.get('version')
+
+    if not _integer(version):
+        raise InvalidChange('The version the changes are based on is required', 'version')
+
+    created = changes.get('created', [])
+    updated = changes.get('updated', [])
+    deleted = changes.get('deleted', [])
+
+    for field, value in (('created', created), ('updated', updated), ('deleted', deleted)):
+        if not isinstance(value, list):
+            raise InvalidChange('Expected a list of changes', field)
+
+    new_rooms = []
+
+    for change in created:
+        if not isinstance(change, dict):
+            raise InvalidChange('Expected an object', 'created')
+
+        key = change.get('key')
+
+        if key is not None and not isinstance(key, (str, int)):
+            raise InvalidChange('Keys of created rooms must be strings or numbers', 'created')
+
+        new_rooms.append((key, str(change.get('name') or ''), parse_polygon(change.get('polygon'), 'created')))
+
+    updates = {}
+
+    for change in updated:
+        if not isinstance(change, dict) or not _integer(change.get('id')):
+            raise InvalidChange('Expected an object with the ID of the room', 'updated')
+
+        values = {}
+
+        if 'name' in change:
+            values['name'] = str(change['name'] or '')
+
+        if 'polygon' in change:
+            values['polygon'] = parse_polygon(change['polygon'], 'updated')
+
+        updates.setdefault(change['id'], {}).update(values)
+
+    if not all(_integer(id) for id in deleted):
+        raise InvalidChange('Expected a list of room IDs', 'deleted')
+
+    rooms = _load_rooms(floor, set(updates) | set(deleted))
+
+    for field, ids in (('updated', updates), ('deleted', deleted)):
+        missing = [ id for id in ids if id not in rooms ]
+
+        if missing:
+            raise InvalidChange(f"No such rooms on floor {floor.id}: {', '.join(map(str, missing))}", field)
+
+    # Claiming the next version in one statement makes concurrent saves based
+    # on the same version conflict instead of overwriting each other.
+    claimed = Floor.query \
+        .filter(Floor.id == floor.id, Floor.version == version) \
+        .update({ Floor.version: version + 1 }, synchronize_session=False)
+
+    if not claimed:
+        raise VersionConflict(version)
+
+    version += 1
+
+    for id, values in updates.items():
+        for key, value in values.items():
+            setattr(rooms[id], key, value)
+
+        rooms[id].version = version
+
+    for id in deleted:
+        rooms[id].deleted = True
+        rooms[id].version = version
+
+    keys = []
+
+    for key, name, polygon in new_rooms:
+        room = Room(floor_id=floor.id, name=name, polygon=polygon, version=version)
+        db.session.add(room)
+        keys.append((key, room))
+
+    db.session.flush()
+    db.session.expire(floor, ['version'])
+
+    return version, { key: room.id for key, room in keys if key is not None }
+
+def changed_rooms(floor, since):
+    # Rooms changed after the given version of the floor, and the IDs of those
+    # deleted after it.
+    rooms = Room.query \
+        .filter(Room.floor_id == floor.id, Room.version > since) \
+        .order_by(Room.id) \
+        .all()
+
+    return [ room for room in rooms if not room.deleted ], [ room.id for room in rooms if room.deleted ]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from itertools import chain
+
+from sqlalchemy import String, case, cast, event, inspect, literal, select
+
+from tsoha import db
+from tsoha.cache import MemoryBackend
+from tsoha.models import User
+
+# Attributes of users that the reporting lines show or follow.
+HIERARCHY_ATTRIBUTES = ('supervisor_id', 'supervisor', 'username', 'name')
+
+def _marker(id):
+    return literal(',', String) + cast(id, String) + literal(',', String)
+
+def _on_path(path, id):
+    # 1 if the user is on the path, else 0. Paths only hold digits and
+    # commas, so a LIKE pattern finds the ID on any database.
+    return case([ (path.like(literal('%', String) + _marker(id) + literal('%', String)), 1) ], else_=0)
+
+def _walk_query(anchor, step, max_depth):
+    # Recursive query over the supervisor links. Each row carries the path of
+    # user IDs it was reached through, and a row whose user already is on its
+    # path closes a cycle and is not followed further. The walk goes one
+    # level past max_depth only to tell whether it was cut short.
+    users = User.__table__
+    tree = anchor.cte('tree', recursive=True)
+    next_user = users.alias('next_user')
+
+    tree = tree.union_all(
+        select([
+            next_user.c.id,
+            next_user.c.username,
+            next_user.c.name,
+            next_user.c.supervisor_id,
+            (tree.c.depth + 1).label('depth'),
+            cast(tree.c.path + cast(next_user.c.id, String) + literal(',', String), String).label('path'),
+            _on_path(tree.c.path, next_user.c.id).label('cycle'),
+        ])
+            .where(step(tree, next_user))
+            .where(tree.c.cycle == 0)
+            .where(tree.c.depth <= max_depth)
+    )
+
+    return select([tree]).where(tree.c.depth > 0).order_by(tree.c.path)
+
+def _walk(query, max_depth):
+    rows = db.session.execute(query).fetchall()
+
+    return dict(
+        users=[
+            dict(id=row.id, username=row.username, name=row.name, supervisor_id=row.supervisor_id, depth=row.depth)
+            for row in rows
+            if not row.cycle and row.depth <= max_depth
+        ],
+        cycle=any(row.cycle for row in rows if row.depth <= max_depth),
+        truncated=any(row.depth > max_depth for row in rows),
+    )
+
+def _start(user_id):
+    users = User.__table__
+
+    return select([
+        users.c.id,
+        users.c.username,
+        users.c.name,
+        users.c.supervisor_id,
+        literal(0).label('depth'),
+        cast(_marker(users.c.id), String).label('path'),
+        literal(0).label('cycle'),
+    ]).where(users.c.id == user_id)
+
+def subordinate_tree_query(user_id, max_depth):
+    return _walk_query(_start(user_id), lambda tree, user: user.c.supervisor_id == tree.c.id, max_depth)
+
+def supervisor_chain_query(user_id, max_depth):
+    return _walk_query(_start(user_id), lambda tree, user: user.c.id == tree.c.supervisor_id, max_depth)
+
+def subordinate_tree(user_id, max_depth):
+    # Everyone reporting to the user directly or through others, down to
+    # max_depth levels, depth first with each subtree following its root.
+    return _walk(subordinate_tree_query(user_id, max_depth), max_depth)
+
+def supervisor_chain(user_id, max_depth):
+    # The supervisor of the user, their supervisor and so on, nearest first.
+    return _walk(supervisor_chain_query(user_id, max_depth), max_depth)
+
+class ReportingLines:
+    # Subordinate trees and supervisor chains, each loaded with one recursive
+    # query and cached in memory of each worker process. The cache is cleared
+    # when a flush changes supervisors, names or users, and again when the
+    # transaction ends. Changes made by other processes show up once the
+    # entries expire after REPORTING_LINES_CACHE_TTL seconds.
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.max_depth = 32
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_depth = app.config.get('REPORTING_LINES_MAX_DEPTH', 32)
+        size = app.config.get('REPORTING_LINES_CACHE_SIZE', 1000)
+
+        if size:
+            self.backend = MemoryBackend(max_size=size, ttl=app.config.get('REPORTING_LINES_CACHE_TTL', 60))
+
+        event.listen(db.session, 'after_flush', self._collect_changes)
+        event.listen(db.session, 'after_commit', self._apply_changes)
+        event.listen(db.session, 'after_rollback', self._apply_changes)
+
+    def depth(self, requested=None):
+        if requested is None:
+            return self.max_depth
+
+        return max(1, min(requested, self.max_depth))
+
+    def subordinates(self, user_id, max_depth=None):
+        return self._cached(('subordinates', user_id, self.depth(max_depth)), subordinate_tree)
+
+    def supervisors(self, user_id, max_depth=None):
+        return self._cached(('supervisors', user_id, self.depth(max_depth)), supervisor_chain)
+
+    def changed(self, session):
+        # Statements that bypass the ORM have to call this.
+        session.info['reporting_lines_changed'] = True
+        self.clear()
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def _cached(self, key, load):
+        if self.backend is None:
+            return load(key[1], key[2])
+
+        value = self.backend.get(key)
+
+        if value is None:
+            value = load(key[1], key[2])
+            self.backend.set(key, value)
+
+        return value
+
+    def _collect_changes(self, session, flush_context):
+        dirty = session.dirty
+
+        for obj in chain(session.new, dirty, session.deleted):
+            if not isinstance(obj, User):
+                continue
+
+            attrs = inspect(obj).attrs
+
+            if obj not in dirty or any(attrs[name].history.has_changes() for name in HIERARCHY_ATTRIBUTES):
+                self.changed(session)
+                return
+
+    def _apply_changes(self, session):
+        # Cleared once more, in case another request cached the state from
+        # before the commit, or this one cached flushed state that was then
+        # rolled back.
+        if session.info.pop('reporting_lines_changed', False):
+            self.clear()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the request latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NO_PHASE = nullcontext()
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_label(value)}"' for key, value in labels.items()) + '}'
+
+class Metrics:
+    # Request statistics of this process, aggregated per endpoint. Every
+    # worker process keeps its own, like the permission cache does.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.latency_sum = defaultdict(float)
+        self.sql_queries = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+        self.phase_seconds = defaultdict(float)
+        self.slow_queries = defaultdict(int)
+
+    def observe(self, method, endpoint, status, duration, queries, sql_seconds, phases):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if duration <= bound), len(LATENCY_BUCKETS))
+
+        with self.lock:
+            self.requests[method, endpoint, status] += 1
+            self.latency[endpoint][bucket] += 1
+            self.latency_sum[endpoint] += duration
+            self.sql_queries[endpoint] += queries
+            self.sql_seconds[endpoint] += sql_seconds
+
+            for phase, seconds in phases.items():
+                self.phase_seconds[endpoint, phase] += seconds
+
+    def observe_slow_query(self, endpoint):
+        with self.lock:
+            self.slow_queries[endpoint] += 1
+
+    def render(self, extra=()):
+        # Prometheus text exposition format. extra holds (name, type, help,
+        # value) samples supplied by the caller.
+        lines = []
+
+        def family(name, help, type):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+
+        with self.lock:
+            family('tsoha_requests_total', 'Requests handled.', 'counter')
+            for (method, endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'tsoha_requests_total{_labels(method=method, endpoint=endpoint, status=status)} {count}')
+
+            family('tsoha_request_duration_seconds', 'Time spent handling requests.', 'histogram')
+            for endpoint, counts in sorted(self.latency.items()):
+                total = 0
+
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                    total += count
+                    lines.append(f'tsoha_request_duration_seconds_bucket{_labels(endpoint=endpoint, le=bound)} {total}')
+
+                lines.append(f'tsoha_request_duration_seconds_sum{_labels(endpoint=endpoint)} {self.latency_sum[endpoint]}')
+                lines.append(f'tsoha_request_duration_seconds_count{_labels(endpoint=endpoint)} {total}')
+
+            family('tsoha_sql_queries_total', 'SQL statements executed while handling requests.', 'counter')
+            for endpoint, count in sorted(self.sql_queries.items()):
+                lines.append(f'tsoha_sql_queries_total{_labels(endpoint=endpoint)} {count}')
+
+            family('tsoha_sql_duration_seconds_total', 'Time spent executing SQL statements.', 'counter')
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                lines.append(f'tsoha_sql_duration_seconds_total{_labels(endpoint=endpoint)} {seconds}')
+
+            family('tsoha_phase_duration_seconds_total', 'Time spent in each phase of handling requests.', 'counter')
+            for (endpoint, phase), seconds in sorted(self.phase_seconds.items()):
+                lines.append(f'tsoha_phase_duration_seconds_total{_labels(endpoint=endpoint, phase=phase)} {seconds}')
+
+            family('tsoha_slow_queries_total', 'SQL statements slower than SLOW_QUERY_THRESHOLD.', 'counter')
+            for endpoint, count in sorted(self.slow_queries.items()):
+                lines.append(f'tsoha_slow_queries_total{_labels(endpoint=endpoint)} {count}')
+
+        for name, type, help, value in extra:
+            family(name, help, type)
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+class Instrumentation:
+    # Per-request SQL statement counts and timings, broken down into phases
+    # (auth, db, serialization, template). The db phase is the time spent in
+    # SQL statements, which the other phases include. Depending on the
+    # configuration the numbers are logged and sent in response headers
+    # (SQL_QUERY_COUNTER), aggregated for /metrics (METRICS), and statements
+    # slower than SLOW_QUERY_THRESHOLD milliseconds are logged with the view
+    # that ran them. With all of them off no event listeners or request hooks
+    # are installed, and phase() returns a shared no-op context manager.
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.report = False
+        self.metrics = None
+        self.slow_query_threshold = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.report = app.config.get('SQL_QUERY_COUNTER', False)
+        self.metrics = Metrics() if app.config.get('METRICS', False) else None
+
+        threshold = app.config.get('SLOW_QUERY_THRESHOLD')
+        self.slow_query_threshold = threshold / 1000 if threshold is not None else None
+
+        self.enabled = bool(self.report or self.metrics or self.slow_query_threshold is not None)
+
+        if not self.enabled:
+            return
+
+        event.listen(Engine, 'before_cursor_execute', self._before_query)
+        event.listen(Engine, 'after_cursor_execute', self._after_query)
+        event.listen(Engine, 'handle_error', self._failed_query)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def phase(self, name):
+        # Context manager adding the time spent inside it to the named phase
+        # of the current request. Nested phases of the same name count once.
+        if not self.enabled or not has_request_context():
+            return _NO_PHASE
+
+        return self._timed_phase(name)
+
+    @contextmanager
+    def _timed_phase(self, name):
+        active = g.setdefault('active_phases', set())
+
+        if name in active:
+            yield
+            return
+
+        active.add(name)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            active.discard(name)
+
+            phases = g.setdefault('phases', {})
+            phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        endpoint = (request.endpoint if has_request_context() else None) or '-'
+
+        if has_request_context():
+            g.sql_queries = g.get('sql_queries', 0) + 1
+            g.sql_time = g.get('sql_time', 0) + elapsed
+
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            self.app.logger.warning('Slow SQL statement (%.1f ms) in %s: %s', elapsed * 1000, endpoint, statement)
+
+            if self.metrics is not None:
+                self.metrics.observe_slow_query(endpoint)
+
+    def _failed_query(self, context):
+        if context.connection is not None and context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+    def _start_request(self):
+        g.request_start = time.perf_counter()
+
+    def _finish_request(self, response):
+        duration = time.perf_counter() - g.get('request_start', time.perf_counter())
+        count = g.get('sql_queries', 0)
+        sql_time = g.get('sql_time', 0)
+
+        phases = dict(g.get('phases', {}))
+        phases['db'] = sql_time
+
+        if self.report:
+            self.app.logger.info(
+                '%s %s (%s): %d SQL statements, %.1f ms (%s)',
+                request.method, request.path, request.endpoint, count, duration * 1000,
+                ', '.join(f'{phase} {seconds * 1000:.1f} ms' for phase, seconds in phases.items()),
+            )
+
+            response.headers.set('X-SQL-Queries', str(count))
+            response.headers.set('Server-Timing', ', '.join(
+                f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in [ ('total', duration), *phases.items() ]
+            ))
+
+        if self.metrics is not None:
+            self.metrics.observe(request.method, request.endpoint or '-', response.status_code, duration, count, sql_time, phases)
+
+        return response
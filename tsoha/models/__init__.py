@@ -23,4 +23,7 @@ class Base(db.Model):
         return json
 
 from .user import User, File
-from .group import Group, GroupMembership
+from .group import Group, GroupMembership, GroupClosure, GroupCycle
+from .floorplan import Building, Floor, Room
+from .search import search, search_query, index_users, index_groups, rebuild_search_index
+from .epoch import AuthorizationEpoch, bump_epochs, bump_epoch_statements, get_epoch
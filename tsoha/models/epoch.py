@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from itertools import chain
+
+from tsoha import db
+from tsoha.models import Base, User, Group, GroupMembership, GroupClosure
+
+from sqlalchemy import and_, event, exists, inspect, literal, or_, select, union
+
+class AuthorizationEpoch(Base):
+    # Counter of changes to what a user can see: their own account, their
+    # memberships, the groups they know of and the users they share a group
+    # with. Responses built only from those can be cached until it changes.
+    # Users without a row are at epoch 0.
+
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete='CASCADE'), primary_key=True)
+    epoch = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+# User attributes that appear in what other users see of them.
+VISIBLE_USER_ATTRIBUTES = ('name', 'username', 'email', 'role', 'supervisor', 'supervisor_id', 'avatar', 'avatar_id')
+
+def _related_groups(groups):
+    # The groups themselves with all of their ancestors and descendants.
+    closure = GroupClosure.__table__
+
+    return union(
+        select([ closure.c.ancestor_id ]).where(closure.c.descendant_id.in_(groups)),
+        select([ closure.c.descendant_id ]).where(closure.c.ancestor_id.in_(groups)),
+    )
+
+def _affected(column, users, groups, shown_users):
+    membership = GroupMembership.__table__
+    table = User.__table__
+    conditions = []
+
+    if users:
+        conditions.append(column.in_(users))
+
+    # Members of a group see the groups below it, the members of those
+    # groups, and the parent of their own groups.
+    if groups:
+        conditions.append(column.in_(
+            select([ membership.c.user_id ]).where(membership.c.group_id.in_(_related_groups(groups)))
+        ))
+
+    # Users are shown together with their supervisor, so the subordinates of
+    # a changed user count as changed too.
+    if shown_users:
+        subordinates = select([ table.c.id ]).where(table.c.supervisor_id.in_(shown_users))
+        shown = or_(membership.c.user_id.in_(shown_users), membership.c.user_id.in_(subordinates))
+
+        conditions.append(column.in_(subordinates))
+        conditions.append(column.in_(
+            select([ membership.c.user_id ]).where(membership.c.group_id.in_(_related_groups(
+                select([ membership.c.group_id ]).where(shown)
+            )))
+        ))
+
+    return or_(*conditions)
+
+def bump_epoch_statements(users, groups, shown_users, now):
+    # The update of the existing epochs and the insert of the missing ones
+    # that bump_epochs runs.
+    epochs = AuthorizationEpoch.__table__
+    table = User.__table__
+
+    update = epochs.update() \
+        .where(_affected(epochs.c.user_id, users, groups, shown_users)) \
+        .values(epoch=epochs.c.epoch + 1, changed_at=now)
+
+    insert = epochs.insert().from_select(
+        ['user_id', 'epoch', 'changed_at'],
+        select([ table.c.id, literal(1), literal(now) ]).where(and_(
+            _affected(table.c.id, users, groups, shown_users),
+            ~exists().where(epochs.c.user_id == table.c.id),
+        )),
+    )
+
+    return update, insert
+
+def bump_epochs(connection, users=(), groups=(), shown_users=()):
+    # Advances the epoch of the given users, of everyone sharing a branch of
+    # the hierarchy with the given groups, and of everyone who sees one of
+    # shown_users. Statements that bypass the ORM have to call this.
+    users, groups, shown_users = list(set(users)), list(set(groups)), list(set(shown_users))
+
+    if not (users or groups or shown_users):
+        return
+
+    for statement in bump_epoch_statements(users, groups, shown_users, datetime.utcnow()):
+        connection.execute(statement)
+
+def get_epoch(connection, user_id):
+    epochs = AuthorizationEpoch.__table__
+
+    row = connection.execute(
+        select([ epochs.c.epoch, epochs.c.changed_at ]).where(epochs.c.user_id == user_id)
+    ).first()
+
+    return (row.epoch, row.changed_at) if row is not None else (0, None)
+
+def _changed(obj, keys):
+    attrs = inspect(obj).attrs
+
+    return any(attrs[key].history.has_changes() for key in keys)
+
+def _collect(objects, users, groups, shown_users, deleted=False):
+    for obj in objects:
+        if isinstance(obj, GroupMembership):
+            users.add(obj.user_id if obj.user_id is not None else obj.user.id)
+            groups.add(obj.group_id if obj.group_id is not None else obj.group.id)
+        elif isinstance(obj, Group):
+            groups.add(obj.id)
+        elif isinstance(obj, User):
+            if not deleted:
+                users.add(obj.id)
+
+            shown_users.add(obj.id)
+
+# Only changes to these can change what users see. Flushes without any are
+# skipped without looking further.
+TRACKED_TYPES = (User, Group, GroupMembership, GroupClosure)
+
+def _touches_tracked(session):
+    return any(isinstance(obj, TRACKED_TYPES) for obj in chain(session.new, session.dirty, session.deleted))
+
+def _moved(obj):
+    return isinstance(obj, Group) and _changed(obj, ('parent', 'parent_id'))
+
+@event.listens_for(db.session, 'before_flush')
+def _bump_before_flush(session, flush_context, instances):
+    # Deleted rows, and the old position of moved groups, can only be looked
+    # up before the flush.
+    if not _touches_tracked(session):
+        return
+
+    users, groups, shown_users = set(), set(), set()
+
+    _collect(session.deleted, users, groups, shown_users, deleted=True)
+    _collect([ obj for obj in session.dirty if _moved(obj) ], users, groups, shown_users)
+
+    bump_epochs(session.connection(), users, groups, shown_users)
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_after_flush(session, flush_context):
+    if not _touches_tracked(session):
+        return
+
+    users, groups, shown_users = set(), set(), set()
+
+    changed = [
+        obj for obj in session.dirty
+        if isinstance(obj, GroupMembership)
+        or (isinstance(obj, Group) and _changed(obj, ('name', 'parent', 'parent_id')))
+        or (isinstance(obj, User) and _changed(obj, VISIBLE_USER_ATTRIBUTES))
+    ]
+
+    _collect(session.new, users, groups, shown_users)
+    _collect(changed, users, groups, shown_users)
+
+    bump_epochs(session.connection(), users, groups, shown_users)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from sqlalchemy.orm import backref, validates
+from sqlalchemy.types import TypeDecorator
+
+from tsoha import db
+from tsoha.models import Base
+
+class Polygon(TypeDecorator):
+    # Outline of a room as a list of (x, y) vertices, stored as JSON.
+    impl = db.Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return json.dumps([ [x, y] for x, y in value ], separators=(',', ':'))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return [ (x, y) for x, y in json.loads(value) ]
+
+class Building(Base):
+    __public__ = ('id', 'name', 'floors')
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+
+class Floor(Base):
+    __public__ = ('id', 'name', 'level', 'version')
+
+    id = db.Column(db.Integer, primary_key=True)
+    building_id = db.Column(db.Integer, db.ForeignKey(Building.id), nullable=False, index=True)
+    name = db.Column(db.String, nullable=False)
+    level = db.Column(db.Integer, nullable=False, default=0)
+
+    # Incremented by every change to the rooms of the floor. Rooms record the
+    # version that last changed them, so that clients can fetch only what
+    # changed since the version they have.
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    building = db.relationship(Building, backref=backref('floors', order_by=level))
+
+class Room(Base):
+    __public__ = ('id', 'name', 'polygon', 'version')
+    __table_args__ = (
+        db.Index('ix_room_floor_id_version', 'floor_id', 'version'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    floor_id = db.Column(db.Integer, db.ForeignKey(Floor.id), nullable=False)
+    name = db.Column(db.String, nullable=False, default='')
+    polygon = db.Column(Polygon, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+
+    # Deleted rooms are kept as tombstones, so that clients catching up from
+    # an older version learn about the deletion.
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+
+    # Bounding box of the polygon, for indexing.
+    min_x = db.Column(db.Float, nullable=False)
+    min_y = db.Column(db.Float, nullable=False)
+    max_x = db.Column(db.Float, nullable=False)
+    max_y = db.Column(db.Float, nullable=False)
+
+    floor = db.relationship(Floor, backref=backref('rooms', lazy='dynamic'))
+
+    @validates('polygon')
+    def _update_bounds(self, key, polygon):
+        xs = [ x for x, _y in polygon ]
+        ys = [ y for _x, y in polygon ]
+
+        self.min_x, self.min_y, self.max_x, self.max_y = min(xs), min(ys), max(xs), max(ys)
+
+        return polygon
@@ -4,24 +4,146 @@
 from tsoha import db
 from tsoha.models import User, Base
 
-from sqlalchemy import Table, and_
+from sqlalchemy import Table, and_, event, inspect, literal, select
+from sqlalchemy.orm import validates
+
+class GroupCycle(Exception):
+    def __init__(self, group_id, parent_id):
+        super().__init__(f'Group {parent_id} is group {group_id} or one of its subgroups, and cannot be its parent')
+        self.group_id = group_id
+        self.parent_id = parent_id
 
 class Group(Base):
     __public__ = ('id', 'name', 'parent', 'subgroups', 'members')
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey(id))
+    name = db.Column(db.String, nullable=False, index=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey(id), index=True)
     parent = db.relationship("Group", remote_side=[id], backref="subgroups")
 
+    @validates('parent', 'parent_id')
+    def _check_parent(self, key, value):
+        # Moves under a subgroup are caught when the closure table is updated,
+        # but a group being its own parent never gets as far as the flush.
+        if value is not None and (value is self or (self.id is not None and value == self.id)):
+            raise GroupCycle(self.id, self.id)
+
+        return value
+
 class GroupMembership(Base):
     __depth__ = 0
     __public__ = ('user', 'group', 'create_users', 'manage_users')
 
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), primary_key=True)
-    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('group.id'), primary_key=True, index=True)
     create_users = db.Column(db.Boolean, default=False, nullable=False)
     manage_users = db.Column(db.Boolean, default=False, nullable=False)
 
     user = db.relationship(User, backref='groups')
     group = db.relationship(Group, backref='members')
+
+class GroupClosure(Base):
+    # One row for every (ancestor, descendant) pair in the group hierarchy,
+    # including a depth 0 row linking each group to itself.
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey(Group.id), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey(Group.id), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+def _attach_subtree(connection, group_id, parent_id):
+    closure = GroupClosure.__table__
+
+    if parent_id is None:
+        return
+
+    ancestors = closure.alias('ancestors')
+    subtree = closure.alias('subtree')
+
+    connection.execute(closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([ancestors.c.ancestor_id, subtree.c.descendant_id, ancestors.c.depth + subtree.c.depth + 1])
+            .where(and_(ancestors.c.descendant_id == parent_id, subtree.c.ancestor_id == group_id)),
+    ))
+
+def _detach_subtree(connection, group_id):
+    closure = GroupClosure.__table__
+
+    subtree = select([closure.c.descendant_id]) \
+        .where(closure.c.ancestor_id == group_id)
+
+    ancestors = select([closure.c.ancestor_id]) \
+        .where(and_(closure.c.descendant_id == group_id, closure.c.ancestor_id != group_id))
+
+    connection.execute(closure.delete().where(and_(
+        closure.c.descendant_id.in_(subtree),
+        closure.c.ancestor_id.in_(ancestors),
+    )))
+
+def _parent_changed(group):
+    attrs = inspect(group).attrs
+
+    return attrs.parent.history.has_changes() or attrs.parent_id.history.has_changes()
+
+@event.listens_for(db.session, 'after_flush')
+def _maintain_group_closure(session, flush_context):
+    created = { group.id: group for group in session.new if isinstance(group, Group) }
+    moved = [ group for group in session.dirty if isinstance(group, Group) and _parent_changed(group) ]
+    deleted = [ group.id for group in session.deleted if isinstance(group, Group) ]
+
+    if not (created or moved or deleted):
+        return
+
+    connection = session.connection()
+    closure = GroupClosure.__table__
+
+    def batch_depth(group):
+        depth = 0
+
+        while group.parent_id in created:
+            group = created[group.parent_id]
+            depth += 1
+
+        return depth
+
+    # Parents created in the same flush need their rows before their children do.
+    for group in sorted(created.values(), key=batch_depth):
+        connection.execute(closure.insert().values(ancestor_id=group.id, descendant_id=group.id, depth=0))
+        _attach_subtree(connection, group.id, group.parent_id)
+
+    for group in moved:
+        # A group moved under itself or its own subtree would be detached from
+        # the hierarchy along with its new parent.
+        if group.parent_id is not None and connection.execute(
+            select([closure.c.depth])
+                .where(closure.c.ancestor_id == group.id)
+                .where(closure.c.descendant_id == group.parent_id)
+        ).first() is not None:
+            raise GroupCycle(group.id, group.parent_id)
+
+        _detach_subtree(connection, group.id)
+        _attach_subtree(connection, group.id, group.parent_id)
+
+    if deleted:
+        connection.execute(closure.delete().where(closure.c.ancestor_id.in_(deleted)))
+        connection.execute(closure.delete().where(closure.c.descendant_id.in_(deleted)))
+
+def rebuild_group_closure(connection):
+    groups = Group.__table__
+    closure = GroupClosure.__table__
+
+    tree = select([
+        groups.c.id.label('ancestor_id'),
+        groups.c.id.label('descendant_id'),
+        literal(0).label('depth'),
+    ]).cte('tree', recursive=True)
+
+    tree = tree.union_all(
+        select([tree.c.ancestor_id, groups.c.id, tree.c.depth + 1])
+            .where(groups.c.parent_id == tree.c.descendant_id)
+    )
+
+    connection.execute(closure.delete())
+    connection.execute(closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select([tree.c.ancestor_id, tree.c.descendant_id, tree.c.depth]),
+    ))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tsoha import db
+from tsoha.models import User, Group
+
+from sqlalchemy import DDL, and_, column, event, func, inspect, literal_column, or_, select, table
+
+# Full-text indexes for the typeahead search, kept as SQLite FTS5 tables
+# whose rowids are the IDs of the indexed users and groups. Other databases
+# fall back to prefix LIKE queries on the model tables.
+
+INDEXES = {
+    'user_search': (User, ('username', 'name', 'email')),
+    'group_search': (Group, ('name',)),
+}
+
+# Ranking with bm25 has to score every match, which for a one or two letter
+# prefix can be a large part of the table. Such queries return matches in ID
+# order instead, which SQLite can stop reading after the first page.
+RANK_MIN_TERM_LENGTH = 3
+
+def _create_statement(name, columns):
+    return f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({', '.join(columns)}, prefix='1 2 3', tokenize='unicode61 remove_diacritics 2')"
+
+def _creates_tables(ddl, target, bind, tables=None, **kw):
+    # create_all also runs for binds without tables of their own, such as the
+    # read-only bind, which must not get the index tables.
+    return bool(tables)
+
+for _name, (_model, _columns) in INDEXES.items():
+    event.listen(db.metadata, 'after_create', DDL(_create_statement(_name, _columns)).execute_if(dialect='sqlite', callable_=_creates_tables))
+    event.listen(db.metadata, 'before_drop', DDL(f'DROP TABLE IF EXISTS {_name}').execute_if(dialect='sqlite', callable_=_creates_tables))
+
+def _index_table(name):
+    return table(name, column('rowid'), *[ column(key) for key in INDEXES[name][1] ])
+
+def _reindex(connection, name, ids=None):
+    # Replaces the index rows of the given IDs, or of every row if ids is None.
+    model, columns = INDEXES[name]
+    source = model.__table__
+    index = _index_table(name)
+
+    rows = select([ source.c.id ] + [ func.coalesce(source.c[key], '') for key in columns ])
+
+    if ids is None:
+        connection.execute(index.delete())
+    else:
+        ids = list(ids)
+        rows = rows.where(source.c.id.in_(ids))
+
+        connection.execute(index.delete().where(index.c.rowid.in_(ids)))
+
+    connection.execute(index.insert().from_select(['rowid', *columns], rows))
+
+def _unindex(connection, name, ids):
+    index = _index_table(name)
+
+    connection.execute(index.delete().where(index.c.rowid.in_(list(ids))))
+
+def index_users(connection, ids):
+    # Statements that bypass the ORM, like the bulk import, have to call this
+    # for the users they insert or update.
+    if connection.dialect.name == 'sqlite':
+        _reindex(connection, 'user_search', ids)
+
+def index_groups(connection, ids):
+    if connection.dialect.name == 'sqlite':
+        _reindex(connection, 'group_search', ids)
+
+def rebuild_search_index(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for name, (_model, columns) in INDEXES.items():
+        connection.execute(DDL(_create_statement(name, columns)))
+        _reindex(connection, name)
+
+def _indexed_fields_changed(obj, columns):
+    attrs = inspect(obj).attrs
+
+    return any(attrs[key].history.has_changes() for key in columns)
+
+@event.listens_for(db.session, 'after_flush')
+def _maintain_search_index(session, flush_context):
+    connection = session.connection()
+
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for name, (model, columns) in INDEXES.items():
+        changed = [
+            obj.id for obj in session.new | session.dirty
+            if isinstance(obj, model) and (obj in session.new or _indexed_fields_changed(obj, columns))
+        ]
+        deleted = [ obj.id for obj in session.deleted if isinstance(obj, model) ]
+
+        if changed:
+            _reindex(connection, name, changed)
+
+        if deleted:
+            _unindex(connection, name, deleted)
+
+def _like_prefix(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search_query(name, text, scope=None, limit=10):
+    # Query for the IDs of the rows whose indexed columns contain a word
+    # starting with each word of text, best matches first, or None if text has
+    # no words. scope optionally restricts the results and is called with the
+    # ID column to build the condition.
+    terms = text.split()
+
+    if not terms:
+        return None
+
+    model, columns = INDEXES[name]
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'sqlite':
+        index = _index_table(name)
+        key = index.c.rowid
+
+        # Quoting keeps FTS5 operators in the input from being interpreted, and
+        # words with punctuation such as 'john.doe' become prefix phrases.
+        match = ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+        query = select([ key ]).where(literal_column(name).op('MATCH')(match))
+
+        if max(len(term) for term in terms) >= RANK_MIN_TERM_LENGTH:
+            query = query.order_by(literal_column('rank'))
+        else:
+            query = query.order_by(key)
+    else:
+        source = model.__table__
+        key = source.c.id
+
+        query = select([ key ]).where(and_(*[
+            or_(*[ source.c[field].ilike(_like_prefix(term), escape='\\') for field in columns ])
+            for term in terms
+        ])).order_by(key)
+
+    # The condition should be checked row by row, e.g. with EXISTS. SQLite
+    # hands an 'IN (...)' on the rowid to FTS5, which then evaluates the whole
+    # MATCH again for every ID in the list.
+    if scope is not None:
+        query = query.where(scope(key))
+
+    return query.limit(limit)
+
+def search(name, text, scope=None, limit=10):
+    query = search_query(name, text, scope, limit)
+
+    if query is None:
+        return []
+
+    return [ id for (id,) in db.session.connection().execute(query) ]
@@ -7,7 +7,7 @@ from sqlalchemy.orm.collections import mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import select
 
-from flask import url_for
+from flask import url_for, current_app
 
 from tsoha import db
 from tsoha.models import Base
@@ -17,10 +17,10 @@ class User(Base):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    username = db.Column(db.String, nullable=False)
+    username = db.Column(db.String, nullable=False, unique=True, index=True)
     email = db.Column(db.String)
     role = db.Column(db.String)
-    supervisor_id = db.Column(db.Integer, db.ForeignKey(id))
+    supervisor_id = db.Column(db.Integer, db.ForeignKey(id), index=True)
     password = db.Column(db.LargeBinary, nullable=False)
     avatar_id = db.Column(db.Integer, db.ForeignKey('file.id'))
 
@@ -31,9 +31,10 @@ class File(Base):
     id = db.Column(db.Integer, primary_key=True)
 
     uploader_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
-    owner_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False, index=True)
 
-    data = db.Column(db.LargeBinary, nullable=False)
+    digest = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
     mimetype = db.Column(db.String, nullable=False)
     name = db.Column(db.String)
 
@@ -41,4 +42,12 @@ class File(Base):
     owner = db.relationship('User', backref='files', foreign_keys=[owner_id])
 
     def toJSON(self, shallow=False):
-        return { 'url': url_for('download_file', id=self.id, name=self.name) }
\ No newline at end of file
+        json = { 'url': url_for('download_file', id=self.id, name=self.name) }
+
+        if self.mimetype.startswith('image/'):
+            json['thumbnails'] = {
+                str(size): url_for('file_thumbnail', id=self.id, size=size)
+                for size in current_app.config['THUMBNAIL_SIZES']
+            }
+
+        return json
\ No newline at end of file
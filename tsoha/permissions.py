@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import Integer, cast, func, select
+
+from tsoha import db, permission_cache
+from tsoha.auth import request_cache
+from tsoha.models import User, Group, GroupMembership, GroupClosure
+
+PERMISSIONS = ('create_users', 'manage_users')
+
+# Groups per statement, to stay well below the bound parameter limit.
+CHUNK_SIZE = 500
+
+def _user_id(user):
+    if isinstance(user, User):
+        return user.id
+
+    if isinstance(user, str):
+        return db.session.query(User.id).filter(User.username == user).scalar()
+
+    return user
+
+def _group_id(group):
+    return group.id if isinstance(group, Group) else int(group)
+
+def effective_permissions_query(users, groups):
+    # A permission granted in any ancestor group applies to all of its
+    # subgroups, so the effective permissions of a user in a group are those
+    # of all the user's memberships in the group's ancestors combined.
+    membership = GroupMembership.__table__
+    closure = GroupClosure.__table__
+
+    return select([
+            membership.c.user_id,
+            closure.c.descendant_id,
+            *[ func.max(cast(membership.c[permission], Integer)) for permission in PERMISSIONS ],
+        ]) \
+        .select_from(membership.join(closure, closure.c.ancestor_id == membership.c.group_id)) \
+        .where(membership.c.user_id.in_(users)) \
+        .where(closure.c.descendant_id.in_(groups)) \
+        .group_by(membership.c.user_id, closure.c.descendant_id)
+
+def permitted_groups_query(user, permission):
+    # IDs of every group in which the user has the permission, for filtering
+    # queries over many groups at once.
+    membership = GroupMembership.__table__
+    closure = GroupClosure.__table__
+
+    return select([ closure.c.descendant_id ]) \
+        .select_from(membership.join(closure, closure.c.ancestor_id == membership.c.group_id)) \
+        .where(membership.c.user_id == _user_id(user)) \
+        .where(membership.c[permission])
+
+def effective_permissions(users, groups):
+    # Both permissions of the users in the groups, in one query per chunk of
+    # groups, as {(user ID, group ID): {permission: bool}}. Pairs missing from
+    # the result have neither permission.
+    users = list(set(users))
+    groups = list(set(groups))
+    result = {}
+
+    for start in range(0, len(groups), CHUNK_SIZE):
+        query = effective_permissions_query(users, groups[start:start + CHUNK_SIZE])
+
+        for user, group, *values in db.session.execute(query):
+            result[user, group] = dict(zip(PERMISSIONS, (bool(value) for value in values)))
+
+    return result
+
+def check_permissions(pairs, permission):
+    # Whether each of the (user, group) pairs has the permission, as
+    # {(user ID, group ID): bool}. Users and groups may be given as objects or
+    # IDs, and users also by username. Answers come from the request and the
+    # permission cache where possible, and the rest are computed together.
+    pairs = set((_user_id(user), _group_id(group)) for user, group in pairs)
+
+    permissions = request_cache('permissions')
+    result = {}
+
+    for user, group in pairs:
+        if user is None:
+            result[user, group] = False
+        elif (user, group, permission) in permissions:
+            result[user, group] = permissions[user, group, permission]
+
+    missing = [ pair for pair in pairs if pair not in result ]
+    cached = permission_cache.get_many([ (user, group, permission) for user, group in missing ])
+
+    for (user, group, _permission), value in cached.items():
+        permissions[user, group, permission] = result[user, group] = value
+
+    missing = [ pair for pair in missing if pair not in result ]
+
+    if missing:
+        computed = effective_permissions(
+            [ user for user, _group in missing ],
+            [ group for _user, group in missing ],
+        )
+
+        # Both permissions are known now, so both are cached.
+        entries = [
+            ((user, group, name), computed.get((user, group), {}).get(name, False))
+            for user, group in missing
+            for name in PERMISSIONS
+        ]
+
+        for key, value in entries:
+            permissions[key] = value
+
+        permission_cache.set_many(entries)
+
+        for user, group in missing:
+            result[user, group] = permissions[user, group, permission]
+
+    return result
+
+def has_permission_in_any_group(user, permission):
+    # Permissions are only granted by memberships, so the user has the
+    # permission somewhere if any of their memberships grants it.
+    memberships = GroupMembership.query \
+        .filter(GroupMembership.user_id == _user_id(user), getattr(GroupMembership, permission))
+
+    return db.session.query(memberships.exists()).scalar()
+
+def allowed_groups(user, groups, permission):
+    # IDs of those of the groups in which the user has the permission.
+    user = _user_id(user)
+    allowed = check_permissions([ (user, group) for group in groups ], permission)
+
+    return set(group for (_user, group), value in allowed.items() if value)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+
+from itertools import islice
+from sqlalchemy import bindparam, or_
+
+from tsoha import db, permission_cache, authorizer, reporting_lines
+from tsoha.auth import password_hasher
+from tsoha.permissions import PERMISSIONS
+from tsoha.models import User, Group, GroupMembership, index_users, bump_epochs
+
+DEFAULT_CHUNK_SIZE = 500
+
+IMPORT_FORMATS = {
+    'csv': 'csv',
+    'text/csv': 'csv',
+    'jsonl': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-ndjson': 'jsonl',
+}
+
+def _parse_group(spec):
+    # CSV group cells look like 'staff;admins+create_users+manage_users'.
+    name, *flags = spec.strip().split('+')
+
+    return dict(
+        name=name,
+        create_users='create_users' in flags,
+        manage_users='manage_users' in flags,
+    )
+
+# Fields of JSON rows that have to be strings when given.
+STRING_FIELDS = ('username', 'name', 'email', 'role', 'password')
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _json_row(row):
+    # Checks the types of a row parsed from JSON, whose values may be
+    # anything, and turns group names into group dictionaries. Returns the
+    # row, or an error row for its first invalid field.
+    def invalid(error, field):
+        username = row.get('username')
+
+        return dict(error=error, field=field, username=username if isinstance(username, str) else None)
+
+    for field in STRING_FIELDS:
+        if row.get(field) is not None and not isinstance(row[field], str):
+            return invalid(f"'{field}' must be a string", field)
+
+    supervisor = row.get('supervisor')
+
+    if supervisor is not None and not (isinstance(supervisor, str) or _is_id(supervisor)):
+        return invalid("'supervisor' must be a username or a user ID", 'supervisor')
+
+    groups = row.get('groups', [])
+
+    if not isinstance(groups, list):
+        return invalid("'groups' must be a list", 'groups')
+
+    row['groups'] = []
+
+    for group in groups:
+        if isinstance(group, str):
+            group = dict(name=group)
+
+        if not isinstance(group, dict) \
+                or not ('id' in group or 'name' in group) \
+                or ('id' in group and not _is_id(group['id'])) \
+                or ('name' in group and not isinstance(group['name'], str)):
+            return invalid('Groups must be names or objects with the ID or the name of the group', 'groups')
+
+        for permission in PERMISSIONS:
+            if not isinstance(group.get(permission, False), bool):
+                return invalid(f"'{permission}' of a group must be true or false", 'groups')
+
+        row['groups'].append(group)
+
+    return row
+
+def read_rows(stream, format):
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            row = { key: value for key, value in row.items() if key and value not in (None, '') }
+
+            if 'groups' in row:
+                row['groups'] = [ _parse_group(spec) for spec in row['groups'].split(';') if spec.strip() ]
+
+            yield row
+
+    elif format == 'jsonl':
+        for line in stream:
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield { 'error': f'Malformed JSON: {e}' }
+                continue
+
+            if not isinstance(row, dict):
+                yield { 'error': 'Each line must contain a JSON object' }
+                continue
+
+            yield _json_row(row)
+
+    else:
+        raise ValueError(f'Unsupported import format: {format}')
+
+class _Import:
+    def __init__(self, authorize):
+        self.authorize = authorize
+        self.allowed = {}
+        self.created = {}
+
+    def resolve_groups(self, rows):
+        ids = set()
+        names = set()
+
+        for row in rows:
+            for group in row.get('groups', []):
+                if 'id' in group:
+                    ids.add(group['id'])
+                elif 'name' in group:
+                    names.add(group['name'])
+
+        groups = Group.query.filter(or_(Group.id.in_(ids), Group.name.in_(names))).all()
+
+        return { group.id: group for group in groups }, { group.name: group for group in groups }
+
+    def resolve_supervisors(self, rows):
+        references = [ row['supervisor'] for row in rows if 'supervisor' in row ]
+
+        ids = [ ref for ref in references if isinstance(ref, int) ]
+        usernames = [ ref for ref in references if isinstance(ref, str) and ref not in self.created ]
+
+        found = db.session.query(User.id, User.username) \
+            .filter(or_(User.id.in_(ids), User.username.in_(usernames))) \
+            .all()
+
+        supervisors = dict(self.created)
+        supervisors.update({ id: id for id, _username in found })
+        supervisors.update({ username: id for id, username in found })
+
+        return supervisors
+
+    def check_groups(self, groups):
+        # Asks about every group of the chunk not seen before at once.
+        if self.authorize is None:
+            return
+
+        unseen = [ group for group in groups if group.id not in self.allowed ]
+
+        if unseen:
+            allowed = self.authorize(unseen)
+            self.allowed.update((group.id, group.id in allowed) for group in unseen)
+
+    def is_allowed(self, group):
+        if self.authorize is None:
+            return True
+
+        return self.allowed[group.id]
+
+    def run_chunk(self, chunk):
+        rows = [ row for _index, row in chunk if 'error' not in row ]
+
+        usernames = [ row['username'] for row in rows if isinstance(row.get('username'), str) ]
+        existing = set(username for (username,) in db.session.query(User.username).filter(User.username.in_(usernames)))
+
+        groups_by_id, groups_by_name = self.resolve_groups(rows)
+        supervisors = self.resolve_supervisors(rows)
+
+        self.check_groups(groups_by_id.values())
+
+        results = []
+        accepted = []
+        pending = set()
+        candidates = set(usernames)
+
+        def fail(index, row, error, field=None):
+            results.append(dict(row=index, username=row.get('username'), status='error', error=error, field=field))
+
+        for index, row in chunk:
+            if 'error' in row:
+                fail(index, row, row['error'], row.get('field'))
+                continue
+
+            username = row.get('username')
+
+            if not username or not isinstance(username, str):
+                fail(index, row, 'Username is required', 'username')
+                continue
+
+            if username in existing or username in self.created or username in pending:
+                fail(index, row, f"Username '{username}' is already taken", 'username')
+                continue
+
+            if not row.get('name'):
+                fail(index, row, 'Name is required', 'name')
+                continue
+
+            supervisor = row.get('supervisor')
+
+            if supervisor is not None and supervisor not in supervisors and supervisor not in candidates:
+                fail(index, row, f'Invalid supervisor: user {supervisor} does not exist', 'supervisor')
+                continue
+
+            memberships = {}
+
+            for group in row.get('groups', []):
+                group_def = groups_by_id.get(group.get('id')) or groups_by_name.get(group.get('name'))
+
+                if group_def is None:
+                    fail(index, row, f'Group {group.get("id") or group.get("name")} does not exist', 'groups')
+                    break
+
+                if not self.is_allowed(group_def):
+                    fail(index, row, f"No 'create_users' permission in group '{group_def.name}' (ID {group_def.id})", 'groups')
+                    break
+
+                # A group listed twice, say by name and by ID, gets one
+                # membership with the flags of both.
+                membership = memberships.setdefault(group_def.id, dict(group_id=group_def.id, create_users=False, manage_users=False))
+                membership['create_users'] |= bool(group.get('create_users', False))
+                membership['manage_users'] |= bool(group.get('manage_users', False))
+            else:
+                pending.add(username)
+                accepted.append((index, row, list(memberships.values())))
+
+        # Rows may name a supervisor defined further down the chunk, and those
+        # are only valid if that row was accepted too.
+        while True:
+            names = set(row['username'] for _index, row, _memberships in accepted)
+            orphans = [
+                entry for entry in accepted
+                if entry[1].get('supervisor') is not None
+                and entry[1]['supervisor'] not in supervisors
+                and entry[1]['supervisor'] not in names
+            ]
+
+            if not orphans:
+                break
+
+            for index, row, memberships in orphans:
+                accepted.remove((index, row, memberships))
+                fail(index, row, f"Invalid supervisor: user {row['supervisor']} was not created", 'supervisor')
+
+        if accepted:
+            self.insert(accepted, supervisors)
+
+            for index, row, _memberships in accepted:
+                results.append(dict(row=index, username=row['username'], status='success', id=self.created[row['username']]))
+
+        return sorted(results, key=lambda result: result['row'])
+
+    def insert(self, accepted, supervisors):
+        users = User.__table__
+        memberships = GroupMembership.__table__
+
+        # Hash the whole chunk at once so that it is spread over every worker
+        # of the password hashing pool.
+        passwords = [ row['password'] for _index, row, _memberships in accepted if row.get('password') ]
+        hashes = iter(password_hasher.hash_many(passwords))
+
+        db.session.execute(users.insert(), [
+            dict(
+                username=row['username'],
+                name=row['name'],
+                email=row.get('email'),
+                role=row.get('role'),
+                password=next(hashes) if row.get('password') else b'',
+            )
+            for _index, row, _memberships in accepted
+        ])
+
+        usernames = [ row['username'] for _index, row, _memberships in accepted ]
+        ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)))
+
+        self.created.update(ids)
+        supervisors.update(ids)
+
+        # Supervisors may be among the users just inserted, so they are linked
+        # only after every user in the chunk has an ID.
+        links = [
+            dict(user=ids[row['username']], supervisor=supervisors[row['supervisor']])
+            for _index, row, _memberships in accepted
+            if row.get('supervisor') is not None
+        ]
+
+        if links:
+            db.session.execute(
+                users.update().where(users.c.id == bindparam('user')).values(supervisor_id=bindparam('supervisor')),
+                links,
+            )
+
+        rows = [
+            dict(user_id=ids[row['username']], **membership)
+            for _index, row, memberships in accepted
+            for membership in memberships
+        ]
+
+        if rows:
+            db.session.execute(memberships.insert(), rows)
+
+        # Core statements bypass the ORM events that normally keep the caches,
+        # the search index and the authorization epochs in sync.
+        permission_cache.invalidate(users=ids.values())
+        authorizer.changed(db.session, users=ids.values())
+        index_users(db.session.connection(), ids.values())
+        bump_epochs(db.session.connection(), users=ids.values(), groups=[ row['group_id'] for row in rows ])
+
+        if links:
+            reporting_lines.changed(db.session)
+
+def import_users(rows, authorize=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Creates users from an iterable of row dictionaries, committing every
+    # chunk_size rows and yielding one result dictionary per row. authorize is
+    # called with a list of groups and returns the IDs of those the rows may
+    # add users to.
+    state = _Import(authorize)
+    rows = enumerate(rows, start=1)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+
+        if not chunk:
+            break
+
+        try:
+            results = state.run_chunk(chunk)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        yield from results
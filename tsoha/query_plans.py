@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+from datetime import datetime
+
+from tsoha import db, co_member_ids, is_co_member, is_known_group
+from tsoha.models import User, Group, GroupMembership, GroupClosure, File, Floor, Room, AuthorizationEpoch, search_query, bump_epoch_statements
+from tsoha.permissions import effective_permissions_query, permitted_groups_query
+from tsoha.hierarchy import subordinate_tree_query, supervisor_chain_query
+from tsoha.export import EXPORT_TABLES, export_query
+
+# Representative forms of the queries issued by the views, commands and
+# relationship loaders. None of them should need a full table scan.
+
+def hot_queries():
+    return [
+        ('authenticate / user_details', User.query.filter(User.username == 'username')),
+        ('get_user', User.query.filter(User.id == 1)),
+        ('get_user_memberships', GroupMembership.query.filter(GroupMembership.user_id == 1)),
+        ('Group.members', GroupMembership.query.filter(GroupMembership.group_id == 1)),
+        ('Group.subgroups', Group.query.filter(Group.parent_id == 1)),
+        ('group by name (commands)', Group.query.filter(Group.name == 'name')),
+        ('User.subordinates', User.query.filter(User.supervisor_id == 1)),
+        ('User.files', File.query.filter(File.owner_id == 1)),
+        ('download_file', File.query.filter(File.id == 1).filter(File.name == 'name')),
+        ('check_permissions', effective_permissions_query([1], [1, 2, 3])),
+        ('check_permissions (many users)', effective_permissions_query([1, 2, 3], [1, 2, 3])),
+        ('get_user_known_groups', Group.query
+            .join(GroupClosure, GroupClosure.descendant_id == Group.id)
+            .join(GroupMembership, GroupMembership.group_id == GroupClosure.ancestor_id)
+            .filter(GroupMembership.user_id == 1)),
+        ('co-members', co_member_ids(User(id=1), after=1, limit=50)),
+        ('co-members including subgroups', co_member_ids(User(id=1), include_subgroups=True, after=1, limit=50)),
+        ('bulk import username lookup', db.session.query(User.username).filter(User.username.in_(['a', 'b']))),
+        ('Building.floors', Floor.query.filter(Floor.building_id == 1)),
+        ('spatial index build', Room.query.filter(Room.floor_id == 1)),
+        ('changed_rooms', Room.query.filter(Room.floor_id == 1, Room.version > 1)),
+        ('get_epoch', AuthorizationEpoch.query.filter(AuthorizationEpoch.user_id == 1)),
+        *[
+            (f'bump_epochs ({kind})', statement)
+            for kind, statement in zip(('update', 'insert'), bump_epoch_statements([1], [1], [1], datetime(2000, 1, 1)))
+        ],
+        ('user search (ranked)', search_query('user_search', 'name', is_co_member(User(id=1)))),
+        ('user search (short prefix)', search_query('user_search', 'na', is_co_member(User(id=1)))),
+        ('group search', search_query('group_search', 'name', is_known_group(User(id=1)))),
+        ('reporting lines (subordinates)', subordinate_tree_query(1, 32)),
+        ('reporting lines (supervisors)', supervisor_chain_query(1, 32)),
+        *[
+            (f'export {table}', export_query(table, permitted_groups_query(1, 'manage_users')))
+            for table in EXPORT_TABLES
+        ],
+    ]
+
+def explain(query):
+    statement = getattr(query, 'statement', query).compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+
+    return [ row[-1] for row in db.session.execute(f'EXPLAIN QUERY PLAN {statement}') ]
+
+# Plan steps that scan something other than a table of the schema, such as
+# the result of a subquery, or that look up a full-text index with MATCH,
+# and so are not full table scans.
+ALLOWED_SCANS = re.compile(r'SCAN (CONSTANT ROW|SUBQUERY \d+|\(subquery-\d+\)|\(join-\d+\)|\w+ VIRTUAL TABLE INDEX \d+:M)')
+
+# Plan steps that compute a common table expression, whose rows are then
+# scanned by name.
+CTE_STEP = re.compile(r'(CO-ROUTINE|MATERIALIZE) (\w+)')
+
+def full_scans(plan):
+    # Every scan counts, including those of aliased tables such as
+    # group_membership_1, which the co-member queries use. So do automatic
+    # indexes, which SQLite builds with a full scan when an index is missing.
+    ctes = set(match.group(2) for match in map(CTE_STEP.match, plan) if match)
+
+    return [
+        step for step in plan
+        if (step.startswith('SCAN ') and not ALLOWED_SCANS.match(step) and step.split()[1] not in ctes)
+        or 'AUTOMATIC' in step
+    ]
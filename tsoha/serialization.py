@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.relationships import RelationshipProperty
+
+from tsoha.models import Base
+
+# Serializes objects exposing toJSON into plain dicts and lists.
+#
+# An object serialized at depth N has its attributes serialized at depth
+# N + __depth__ (1 by default), and objects deeper than 1 are shallow, i.e.
+# leave out their relationships. Values inside plain dicts and nested lists
+# start over from depth 0.
+#
+# The fields argument of serialize and eager_load restricts the top-level
+# object to a subset of its public attributes, and depth sets the depth it is
+# serialized at.
+
+MAX_EAGER_PATH_LENGTH = 8
+
+_compiled = {}
+
+def _compile(cls):
+    if cls in _compiled:
+        return _compiled[cls]
+
+    delta = cls.__depth__ if hasattr(cls, '__depth__') else 1
+
+    if issubclass(cls, Base) and cls.toJSON is Base.toJSON:
+        mapper = inspect(cls)
+
+        fields = tuple(
+            (key, isinstance(mapper.attrs[key], RelationshipProperty))
+            for key in cls.__public__
+        )
+
+        def items(obj, shallow, only=None):
+            return [
+                (key, getattr(obj, key)) for key, relationship in fields
+                if not (shallow and relationship) and (only is None or key in only)
+            ]
+    else:
+        fields = None
+
+        def items(obj, shallow, only=None):
+            return [
+                (key, value) for key, value in obj.toJSON(shallow=shallow).items()
+                if only is None or key in only
+            ]
+
+    _compiled[cls] = (delta, fields, items)
+
+    return _compiled[cls]
+
+def _has_to_json(value):
+    return hasattr(value, 'toJSON') and callable(value.toJSON)
+
+def _serialize_object(obj, depth, fields=None):
+    delta, _fields, items = _compile(type(obj))
+    result = {}
+
+    for key, value in items(obj, depth > 1, fields):
+        if isinstance(value, (tuple, list, set)):
+            result[key] = [ _serialize_attribute(v, depth + delta) for v in value ]
+        else:
+            result[key] = _serialize_attribute(value, depth + delta)
+
+    return result
+
+def _serialize_attribute(value, depth):
+    if _has_to_json(value):
+        return _serialize_object(value, depth)
+
+    return serialize(value)
+
+def serialize(value, fields=None, depth=0):
+    if _has_to_json(value):
+        return _serialize_object(value, depth, fields)
+
+    if isinstance(value, dict):
+        return { key: serialize(v) for key, v in value.items() }
+
+    if isinstance(value, (tuple, list)):
+        return [ serialize(v) for v in value ]
+
+    return value
+
+def _eager_paths(cls, depth, length=0, only=None):
+    delta, fields, _items = _compile(cls)
+
+    if fields is None or depth > 1 or length >= MAX_EAGER_PATH_LENGTH:
+        return []
+
+    mapper = inspect(cls)
+    paths = []
+
+    for key, relationship in fields:
+        if not relationship or (only is not None and key not in only):
+            continue
+
+        attribute = getattr(cls, key)
+        subpaths = _eager_paths(mapper.attrs[key].mapper.class_, depth + delta, length + 1)
+
+        paths.extend([ (attribute,) + subpath for subpath in subpaths ] or [ (attribute,) ])
+
+    return paths
+
+def eager_load(cls, depth=0, fields=None):
+    # Loader options fetching every relationship that serializing instances of
+    # cls touches, so that a list of any size serializes in a fixed number of
+    # queries.
+    options = []
+
+    for path in _eager_paths(cls, depth, only=fields):
+        option = selectinload(path[0])
+
+        for attribute in path[1:]:
+            option = option.selectinload(attribute)
+
+        options.append(option)
+
+    return options
+
+class CustomEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if _has_to_json(obj):
+            return serialize(obj)
+
+        return super().default(obj)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import array
+import struct
+import tempfile
+
+from bisect import bisect_left
+
+# Binary snapshots of the effective permissions for offline readers such as
+# door controllers. This module only uses the standard library, so that it
+# can be copied to devices as the loader as is.
+#
+# All integers are little-endian, and every section starts at a multiple of
+# eight bytes. A file is a header followed by these sections:
+#
+#   string offsets   (string count + 1) x u32, into the string data
+#   string data      UTF-8
+#   actions          action count x u32, string indexes of the action names
+#   group IDs        group count x u32, ascending
+#   group names      group count x u32, string indexes
+#   user IDs         user count x u32, ascending
+#   usernames        user count x u32, string indexes
+#   username order   user count x u32, user indexes in username order
+#   rows             user count x action count x row size bytes: for every
+#                    user and action a bitset over the group indexes, the
+#                    lowest bit of the first byte standing for group index 0
+#   removed users    removed count x u32, ascending user IDs
+#
+# A delta holds the users that were added or changed since its base version
+# and the IDs of the removed ones, along with the full group table, which
+# has to be the same as in the base.
+
+MAGIC = b'TSPS'
+FORMAT_VERSION = 1
+
+FULL = 0
+DELTA = 1
+
+SECTIONS = ('string_offsets', 'strings', 'actions', 'group_ids', 'group_names', 'user_ids', 'usernames', 'username_order', 'rows', 'removed')
+
+HEADER = struct.Struct('<4sHHQQIIIIII' + 'Q' * len(SECTIONS))
+
+MAX_ID = 2 ** 32 - 1
+
+class PermissionTable:
+    # The effective permissions in plain Python objects: the action names,
+    # (ID, name) of every group and (ID, username) of every user, both sorted
+    # by ID, and {user ID: tuple of bitsets, one per action}, as integers
+    # whose bit i stands for the group at index i.
+
+    def __init__(self, actions, groups, users, rows):
+        self.actions = tuple(actions)
+        self.groups = sorted(groups)
+        self.users = sorted(users)
+        self.rows = rows
+
+    def __eq__(self, other):
+        return (self.actions, self.groups, self.users, self.rows) == (other.actions, other.groups, other.users, other.rows)
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _u32(values):
+    values = array.array('I', values)
+
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values.tobytes()
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+
+    return mask
+
+def _write(path, kind, version, base_version, actions, groups, users, rows, removed):
+    strings = {}
+    string_list = []
+
+    def string(value):
+        if value not in strings:
+            strings[value] = len(string_list)
+            string_list.append(value)
+
+        return strings[value]
+
+    for id in [ id for id, _name in groups ] + [ id for id, _name in users ] + list(removed):
+        if not 0 <= id <= MAX_ID:
+            raise ValueError(f'ID {id} does not fit the snapshot format')
+
+    action_strings = [ string(action) for action in actions ]
+    group_strings = [ string(name or '') for _id, name in groups ]
+    user_strings = [ string(username) for _id, username in users ]
+
+    encoded = [ value.encode('utf-8') for value in string_list ]
+    offsets = [ 0 ]
+
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+
+    row_size = (len(groups) + 7) // 8
+    order = sorted(range(len(users)), key=lambda index: encoded[user_strings[index]])
+
+    row_data = b''.join(
+        bits.to_bytes(row_size, 'little')
+        for id, _username in users
+        for bits in rows[id]
+    )
+
+    sections = [
+        _u32(offsets),
+        b''.join(encoded),
+        _u32(action_strings),
+        _u32([ id for id, _name in groups ]),
+        _u32(group_strings),
+        _u32([ id for id, _name in users ]),
+        _u32(user_strings),
+        _u32(order),
+        row_data,
+        _u32(sorted(removed)),
+    ]
+
+    positions = []
+    offset = _align(HEADER.size)
+
+    for data in sections:
+        positions.append(offset)
+        offset = _align(offset + len(data))
+
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, kind, version, base_version,
+        len(actions), len(groups), len(users), len(removed), row_size, len(string_list),
+        *positions,
+    )
+
+    # Written next to the target and renamed over it, so that readers never
+    # see a partly written file.
+    directory = os.path.dirname(os.path.abspath(path))
+
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as file:
+        file.write(header)
+
+        for position, data in zip(positions, sections):
+            file.write(b'\0' * (position - file.tell()))
+            file.write(data)
+
+    # The temporary file is only readable by its owner, but readers may run
+    # as other users, so it gets the mode a new file would have had.
+    os.chmod(file.name, 0o666 & ~_umask())
+    os.replace(file.name, path)
+
+def write_snapshot(path, table, version):
+    _write(path, FULL, version, 0, table.actions, table.groups, table.users, table.rows, ())
+
+def write_delta(path, base, table, version, base_version):
+    # Changes from base to table, which both are PermissionTables. Raises
+    # ValueError if the groups or actions differ, since the rows of the
+    # unchanged users would then need rewriting too.
+    if base.actions != table.actions or base.groups != table.groups:
+        raise ValueError('The groups have changed since the base version, a full snapshot is needed')
+
+    old = dict(base.users)
+    current = dict(table.users)
+
+    changed = [
+        (id, username) for id, username in table.users
+        if old.get(id) != username or base.rows.get(id) != table.rows[id]
+    ]
+
+    removed = [ id for id in old if id not in current ]
+
+    _write(path, DELTA, version, base_version, table.actions, table.groups, changed, table.rows, removed)
+
+    return len(changed), len(removed)
+
+class SnapshotFile:
+    # Read-only view of a snapshot or delta file through mmap. Opening it
+    # only reads the header, and lookups binary search the sections in
+    # place.
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = HEADER.unpack_from(self.map, 0)
+        magic, format_version, self.kind, self.version, self.base_version = fields[:5]
+        self.action_count, self.group_count, self.user_count, self.removed_count, self.row_size, string_count = fields[5:11]
+        positions = dict(zip(SECTIONS, fields[11:]))
+
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self.map.close()
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} permission snapshot')
+
+        view = memoryview(self.map)
+
+        def u32(name, count):
+            section = view[positions[name]:positions[name] + 4 * count]
+
+            if sys.byteorder == 'little':
+                return section.cast('I')
+
+            # Big-endian hosts get a swapped copy instead.
+            values = array.array('I', section)
+            values.byteswap()
+
+            return values
+
+        self.string_offsets = u32('string_offsets', string_count + 1)
+        self.strings = view[positions['strings']:positions['strings'] + self.string_offsets[-1]]
+        self.action_strings = u32('actions', self.action_count)
+        self.group_ids = u32('group_ids', self.group_count)
+        self.group_names = u32('group_names', self.group_count)
+        self.user_ids = u32('user_ids', self.user_count)
+        self.usernames = u32('usernames', self.user_count)
+        self.username_order = u32('username_order', self.user_count)
+        self.rows = view[positions['rows']:positions['rows'] + self.user_count * self.action_count * self.row_size]
+        self.removed = u32('removed', self.removed_count)
+
+        self.actions = { self.string(index): number for number, index in enumerate(self.action_strings) }
+
+    def close(self):
+        for name in ('string_offsets', 'strings', 'action_strings', 'group_ids', 'group_names', 'user_ids', 'usernames', 'username_order', 'rows', 'removed'):
+            value = getattr(self, name)
+
+            if isinstance(value, memoryview):
+                value.release()
+
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_delta(self):
+        return self.kind == DELTA
+
+    def _string_bytes(self, index):
+        return bytes(self.strings[self.string_offsets[index]:self.string_offsets[index + 1]])
+
+    def string(self, index):
+        return self._string_bytes(index).decode('utf-8')
+
+    def _find(self, values, value):
+        index = bisect_left(values, value)
+
+        return index if index < len(values) and values[index] == value else None
+
+    def user_index(self, user):
+        # Index of a user given by ID or by username, or None.
+        if not isinstance(user, str):
+            return self._find(self.user_ids, user)
+
+        key = user.encode('utf-8')
+        low, high = 0, self.user_count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._string_bytes(self.usernames[self.username_order[middle]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.user_count and self._string_bytes(self.usernames[self.username_order[low]]) == key:
+            return self.username_order[low]
+
+        return None
+
+    def group_index(self, group_id):
+        return self._find(self.group_ids, group_id)
+
+    def allowed(self, user, group_id, action):
+        # Whether the user, given by ID or username, may perform the action in
+        # the group.
+        user = self.user_index(user)
+        group = self.group_index(group_id)
+        action = self.actions.get(action)
+
+        if user is None or group is None or action is None:
+            return False
+
+        row = (user * self.action_count + action) * self.row_size
+
+        return bool(self.rows[row + group // 8] & (1 << (group % 8)))
+
+    def table(self):
+        # The whole contents as a PermissionTable.
+        actions = [ self.string(index) for index in self.action_strings ]
+        groups = [ (self.group_ids[i], self.string(self.group_names[i])) for i in range(self.group_count) ]
+        users = [ (self.user_ids[i], self.string(self.usernames[i])) for i in range(self.user_count) ]
+
+        rows = {}
+
+        for i, (id, _username) in enumerate(users):
+            start = i * self.action_count * self.row_size
+
+            rows[id] = tuple(
+                int.from_bytes(self.rows[start + a * self.row_size:start + (a + 1) * self.row_size], 'little')
+                for a in range(self.action_count)
+            )
+
+        return PermissionTable(actions, groups, users, rows)
+
+def apply_delta(base, delta):
+    # The PermissionTable of the version a delta leads to, from open
+    # SnapshotFiles of its base and of the delta.
+    if not delta.is_delta or delta.base_version != base.version:
+        raise ValueError(f'The delta does not apply to version {base.version}')
+
+    table = base.table()
+    changes = delta.table()
+
+    if changes.groups != table.groups or changes.actions != table.actions:
+        raise ValueError('The delta has a different group table than its base')
+
+    removed = set(delta.removed)
+    users = dict(table.users)
+
+    for id in removed:
+        users.pop(id, None)
+        table.rows.pop(id, None)
+
+    users.update(changes.users)
+    table.rows.update(changes.rows)
+
+    return PermissionTable(table.actions, table.groups, users.items(), table.rows)
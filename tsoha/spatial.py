@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import select
+
+from tsoha import db
+from tsoha.models import Room
+
+MAX_GRID_SIZE = 256
+
+def contains(polygon, x, y):
+    # Even-odd rule: a point is inside if a ray from it crosses the outline an
+    # odd number of times.
+    inside = False
+    x1, y1 = polygon[-1]
+
+    for x2, y2 in polygon:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+
+        x1, y1 = x2, y2
+
+    return inside
+
+def bounds(polygon):
+    xs = [ x for x, _y in polygon ]
+    ys = [ y for _x, y in polygon ]
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+class GridIndex:
+    # Rooms of one floor bucketed into a uniform grid by their bounding boxes.
+    # The cell size follows the average room size, so that a room covers only
+    # a few cells and a cell holds only a few rooms. It is kept to at most
+    # MAX_GRID_SIZE cells across the floor, so that an outsized room cannot
+    # cover millions of them.
+
+    def __init__(self, rooms):
+        self.rooms = { room['id']: (bounds(room['polygon']), room) for room in rooms }
+        self.cells = defaultdict(list)
+
+        boxes = [ box for box, _room in self.rooms.values() ]
+        self.cell_size = 1.0
+
+        if boxes:
+            average = sum(max(box[2] - box[0], box[3] - box[1]) for box in boxes) / len(boxes)
+            extent = max(max(box[2] for box in boxes) - min(box[0] for box in boxes), max(box[3] for box in boxes) - min(box[1] for box in boxes))
+
+            self.cell_size = max(average, extent / MAX_GRID_SIZE, 1e-9)
+
+        for id, (box, _room) in self.rooms.items():
+            for cell in self._cells(box):
+                self.cells[cell].append(id)
+
+    def _cells(self, box):
+        min_x, min_y, max_x, max_y = (math.floor(value / self.cell_size) for value in box)
+
+        return ((x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+
+    def _cell_count(self, box):
+        return (math.floor(box[2] / self.cell_size) - math.floor(box[0] / self.cell_size) + 1) \
+            * (math.floor(box[3] / self.cell_size) - math.floor(box[1] / self.cell_size) + 1)
+
+    def at(self, x, y):
+        # Rooms containing the point.
+        cell = (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+        return [
+            room for box, room in (self.rooms[id] for id in self.cells.get(cell, ()))
+            if intersects(box, (x, y, x, y)) and contains(room['polygon'], x, y)
+        ]
+
+    def within(self, box):
+        # Rooms whose bounding box overlaps the box, in ID order.
+        if self._cell_count(box) > len(self.rooms):
+            ids = self.rooms.keys()
+        else:
+            ids = set(id for cell in self._cells(box) for id in self.cells.get(cell, ()))
+
+        return [ room for room_box, room in (self.rooms[id] for id in sorted(ids)) if intersects(room_box, box) ]
+
+    def all(self):
+        return [ room for _box, room in (self.rooms[id] for id in sorted(self.rooms)) ]
+
+class SpatialIndex:
+    # Grid indexes of the most recently used floors, in memory of each worker
+    # process. An index is built from the database on first use, and rebuilt
+    # when the version of its floor has moved on, which also picks up changes
+    # made by other processes.
+
+    def __init__(self, app=None):
+        self.max_floors = 64
+        self.floors = OrderedDict()
+        self.lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_floors = app.config.get('SPATIAL_INDEX_FLOORS', 64)
+
+    def get(self, floor):
+        with self.lock:
+            entry = self.floors.get(floor.id)
+
+            if entry is not None and entry[0] == floor.version:
+                self.floors.move_to_end(floor.id)
+                return entry[1]
+
+        index = self.build(floor.id)
+
+        with self.lock:
+            self.floors[floor.id] = (floor.version, index)
+            self.floors.move_to_end(floor.id)
+
+            while len(self.floors) > self.max_floors:
+                self.floors.popitem(last=False)
+
+        return index
+
+    def build(self, floor_id):
+        rooms = Room.__table__
+
+        rows = db.session.execute(
+            select([ rooms.c.id, rooms.c.name, rooms.c.polygon, rooms.c.version ])
+                .where(rooms.c.floor_id == floor_id)
+                .where(~rooms.c.deleted)
+        )
+
+        return GridIndex([ dict(row) for row in rows ])
+
+    def clear(self):
+        with self.lock:
+            self.floors.clear()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+class BlobTooLarge(Exception):
+    pass
+
+class BlobStore:
+    # Content-addressed file storage: every blob is stored once, under the
+    # SHA-256 digest of its contents.
+
+    def __init__(self, app=None):
+        self.root = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('BLOB_STORAGE_PATH') or os.path.join(app.instance_path, 'blobs')
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def put(self, data, max_size=None):
+        # Accepts either bytes or a readable binary stream and returns the
+        # digest and size of the stored blob. Streams are copied in chunks,
+        # and the upload is abandoned as soon as it exceeds max_size.
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            chunks = [ bytes(data) ]
+        else:
+            chunks = iter(lambda: data.read(CHUNK_SIZE), b'')
+
+        os.makedirs(self.root, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+
+        fd, temporary = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(f'Blob exceeds the maximum size of {max_size} bytes')
+
+                    f.write(chunk)
+
+            digest = digest.hexdigest()
+            path = self.path(digest)
+
+            if os.path.exists(path):
+                os.unlink(temporary)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+            raise
+
+        return digest, size
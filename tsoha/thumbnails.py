@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+DEFAULT_THUMBNAIL_SIZES = [64, 256]
+
+FORMATS = (
+    ('jpg', 'JPEG', 'image/jpeg'),
+    ('png', 'PNG', 'image/png'),
+)
+
+class Thumbnailer:
+    # Square-bounded thumbnails of image blobs, cached on disk next to the
+    # blob store and keyed by the digest of the original.
+
+    def __init__(self, app=None, store=None):
+        self.store = store
+        self.root = None
+        self.sizes = []
+
+        if app is not None:
+            self.init_app(app, store)
+
+    def init_app(self, app, store):
+        app.config.setdefault('THUMBNAIL_SIZES', DEFAULT_THUMBNAIL_SIZES)
+
+        self.store = store
+        self.root = os.path.join(store.root, 'thumbnails')
+        self.sizes = app.config['THUMBNAIL_SIZES']
+
+    def path(self, digest, size, extension):
+        return os.path.join(self.root, str(size), digest[:2], f'{digest}.{extension}')
+
+    def find(self, digest, size):
+        for extension, _format, mimetype in FORMATS:
+            path = self.path(digest, size, extension)
+
+            if os.path.exists(path):
+                return path, mimetype
+
+        return None
+
+    def generate(self, digest, size):
+        from PIL import Image, ImageOps
+
+        with self.store.open(digest) as f:
+            image = Image.open(f)
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+
+        # Keep transparency where the original has it, otherwise JPEG is a
+        # fraction of the size.
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            extension, format, mimetype = FORMATS[1]
+            image = image.convert('RGBA')
+            options = dict(optimize=True)
+        else:
+            extension, format, mimetype = FORMATS[0]
+            image = image.convert('RGB')
+            options = dict(quality=85, optimize=True)
+
+        path = self.path(digest, size, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.thumbnail-')
+
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format, **options)
+
+        os.replace(temporary, path)
+
+        return path, mimetype
+
+    def get(self, file, size):
+        # Returns the path and mimetype of the thumbnail, generating it on
+        # first use, or None if the file is not an image we can decode.
+        if size not in self.sizes or not file.mimetype.startswith('image/'):
+            return None
+
+        thumbnail = self.find(file.digest, size)
+
+        if thumbnail is not None:
+            return thumbnail
+
+        # Pillow is imported on first use, as most processes never need it.
+        from PIL import Image
+
+        try:
+            return self.generate(file.digest, size)
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+    def generate_all(self, file):
+        for size in self.sizes:
+            if self.get(file, size) is None:
+                break